@@ -0,0 +1,172 @@
+# Copyright (c) 2021 IMAGE Project, Shared Reality Lab, McGill University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# and our Additional Terms along with this program.
+# If not, see
+# <https://github.com/Shared-Reality-Lab/IMAGE-server/blob/main/LICENSE>.
+#
+# Cheap first stage for the categoriser: a few features computed on a
+# thumbnail decide the obvious charts and text screenshots, everything
+# else goes to the network. To measure how often it answers and how
+# often it agrees with the network and the labels, replay a CSV of
+# "path,label" rows with
+#     python cascade.py --replay labelled.csv
+
+import argparse
+import csv
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+
+THUMBNAIL_SIDE = 128
+# a graphic is "text" when a handful of near-grey colours with dense
+# edges cover it, and a "chart" when a handful of flat colours with
+# sparser edges do
+TEXT_TOP8_COVERAGE = 0.95
+TEXT_MAX_SATURATION = 20
+TEXT_MIN_EDGE_DENSITY = 0.08
+CHART_TOP8_COVERAGE = 0.95
+CHART_MAX_ENTROPY = 3.5
+CHART_MAX_EDGE_DENSITY = 0.12
+# very elongated graphics (banners, strips) are never called charts
+MAX_ASPECT = 6.0
+
+
+def features(img):
+    """
+    Colour coverage, edge density, grey-level entropy, saturation and
+    aspect ratio of a BGR image, computed on a small thumbnail
+    """
+    height, width = img.shape[:2]
+    scale = THUMBNAIL_SIDE / max(height, width)
+    if scale < 1:
+        img = cv2.resize(img, (max(1, int(width * scale)),
+                               max(1, int(height * scale))),
+                         interpolation=cv2.INTER_AREA)
+    # colours quantised to 4 bits per channel
+    quantised = (img >> 4).astype(np.int32)
+    codes = (quantised[..., 0] << 8) | (quantised[..., 1] << 4) \
+        | quantised[..., 2]
+    counts = np.sort(np.bincount(codes.ravel(), minlength=4096))[::-1]
+    total = counts.sum()
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    histogram = np.bincount(gray.ravel(), minlength=256) / gray.size
+    histogram = histogram[histogram > 0]
+    edges = cv2.Canny(gray, 100, 200)
+    saturation = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)[..., 1]
+    return {
+        "colours": int(np.count_nonzero(counts)),
+        "top8_coverage": float(counts[:8].sum() / total),
+        "edge_density": float(np.count_nonzero(edges) / edges.size),
+        "entropy": float(-(histogram * np.log2(histogram)).sum()),
+        "saturation": float(saturation.mean()),
+        "aspect": max(width, height) / min(width, height),
+    }
+
+
+def shortcut(img):
+    """
+    Returns "text" or "chart" when the features are unambiguous, or None
+    when the graphic has to go to the network
+    """
+    f = features(img)
+    if f["top8_coverage"] >= TEXT_TOP8_COVERAGE \
+            and f["saturation"] <= TEXT_MAX_SATURATION \
+            and f["edge_density"] >= TEXT_MIN_EDGE_DENSITY:
+        return "text"
+    if f["aspect"] <= MAX_ASPECT \
+            and f["top8_coverage"] >= CHART_TOP8_COVERAGE \
+            and f["entropy"] <= CHART_MAX_ENTROPY \
+            and f["edge_density"] <= CHART_MAX_EDGE_DENSITY:
+        return "chart"
+    return None
+
+
+def replay(rows):
+    """
+    Runs the cascade and the network on every (path, label) row and
+    returns the hit rate, the agreement of the cascade answers with the
+    network and with the labels, and the time spent in each stage
+    """
+    # imported here so the features can be used without loading the model
+    import categoriser
+
+    report = {"images": 0, "hits": 0, "agree_network": 0,
+              "agree_label": 0, "network_correct": 0,
+              "cascade_ms": 0.0, "network_ms": 0.0, "by_label": {}}
+    for path, label in rows:
+        with open(path, 'rb') as f:
+            img = categoriser.decode(f.read())
+        if img is None:
+            continue
+        start = time.perf_counter()
+        guess = shortcut(img)
+        report["cascade_ms"] += (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        probabilities = categoriser.classify([img])[0]
+        report["network_ms"] += (time.perf_counter() - start) * 1000
+        network = categoriser.labels[int(probabilities.argmax())]
+
+        report["images"] += 1
+        report["network_correct"] += network == label
+        stats = report["by_label"].setdefault(
+            label, {"images": 0, "hits": 0, "agree_label": 0})
+        stats["images"] += 1
+        if guess is not None:
+            report["hits"] += 1
+            report["agree_network"] += guess == network
+            report["agree_label"] += guess == label
+            stats["hits"] += 1
+            stats["agree_label"] += guess == label
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the heuristic cascade on a labelled set")
+    parser.add_argument('--replay', required=True,
+                        help="CSV of image path,label rows")
+    parser.add_argument('--json', help="also write the report here")
+    args = parser.parse_args()
+    with open(args.replay) as f:
+        base = os.path.dirname(os.path.abspath(args.replay))
+        rows = [(os.path.join(base, row[0]), row[1].strip())
+                for row in csv.reader(f) if row]
+    report = replay(rows)
+
+    n, hits = report["images"], report["hits"]
+    print("{} images".format(n))
+    if n == 0:
+        return
+    print("cascade hit rate       {:.1%}".format(hits / n))
+    if hits:
+        print("agreement with network {:.1%}".format(
+            report["agree_network"] / hits))
+        print("agreement with labels  {:.1%}".format(
+            report["agree_label"] / hits))
+    print("network accuracy       {:.1%}".format(
+        report["network_correct"] / n))
+    print("mean cascade / network {:.2f} / {:.1f} ms".format(
+        report["cascade_ms"] / n, report["network_ms"] / n))
+    for label, stats in sorted(report["by_label"].items()):
+        print("  {:<12} {:>5} images, {:>5} hits, {:>5} correct".format(
+            label, stats["images"], stats["hits"], stats["agree_label"]))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,7 @@
 # and our Additional Terms along with this program.
 # If not, see
 # <https://github.com/Shared-Reality-Lab/IMAGE-server/blob/main/LICENSE>.
+import os
 import torch
 from torch import nn
 import pytorch_lightning as pl
@@ -25,34 +26,124 @@ import time
 import jsonschema
 import logging
 import base64
+import io
+from PIL import Image
+import cascade
 
 app = Flask(__name__)
+logging.basicConfig(level=logging.NOTSET)
+
+# the network runs on CPU; CATEGORISER_THREADS sets its intra-op thread
+# count (0 keeps the PyTorch default)
+CATEGORISER_THREADS = int(os.environ.get("CATEGORISER_THREADS", 0))
+if CATEGORISER_THREADS > 0:
+    torch.set_num_threads(CATEGORISER_THREADS)
+IMAGE_SIZE = 224
+# CATEGORISER_CASCADE=1 lets the heuristic stage in cascade.py answer
+# obvious charts and text before the network is run
+CATEGORISER_CASCADE = os.environ.get("CATEGORISER_CASCADE", "0") == "1"
+labels = ["chart", "photograph", "other", "text"]
+# ImageNet statistics the DenseNet backbone was trained with
+mean = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+std = np.array([0.229, 0.224, 0.225], dtype=np.float32)
 
 
 class Net(pl.LightningModule):
     # initial initialisation if architecture. It  is needed to load the weights
-    def __init__(self, num_classes=10, lr=1e-3):
+    def __init__(self, num_classes=10, lr=1e-3, pretrained=True):
         super().__init__()
         self.save_hyperparameters()
-        self.model = models.densenet121(pretrained=True)
+        self.model = models.densenet121(pretrained=pretrained)
         for param in self.model.parameters():
             param.requires_grad = False
         self.model.classifier = nn.Linear(self.model.classifier.in_features, 4)
 
-    # the main loop used for prediction.
+    # the main loop used for prediction; returns the logits of a batch
     def forward(self, x):
-        logits = self.model(x)
-        preds = torch.argmax(logits, 1)
-        pred_int = preds.int()
-        pred_int = pred_int.detach().numpy()
-        return str(pred_int[0])
+        return self.model(x)
+
+
+def load_model(checkpoint='./latest-0.ckpt'):
+    """
+    Loads the trained weights once and freezes the network into a
+    TorchScript module for CPU inference
+    """
+    # the ImageNet weights are overwritten by the checkpoint, so they
+    # do not need to be loaded first
+    net = Net.load_from_checkpoint(checkpoint, map_location='cpu',
+                                   pretrained=False)
+    net.eval()
+    example = torch.zeros(1, 3, IMAGE_SIZE, IMAGE_SIZE)
+    with torch.no_grad():
+        traced = torch.jit.trace(net.model, example)
+    model = torch.jit.freeze(traced)
+    # the first calls optimise the frozen graph
+    with torch.no_grad():
+        for _ in range(2):
+            model(example)
+    return model
+
+
+# cv2 flags that decode at 1/2, 1/4 and 1/8 of the full resolution
+REDUCED_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8),
+                 (4, cv2.IMREAD_REDUCED_COLOR_4),
+                 (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+
+def decode(binary, size=IMAGE_SIZE):
+    """
+    Decodes an encoded image to BGR, only at the resolution needed for a
+    size x size input: the dimensions are read from the header and the
+    largest reduction that keeps both sides at least size is used
+    """
+    flag = cv2.IMREAD_COLOR
+    try:
+        width, height = Image.open(io.BytesIO(binary)).size
+        for factor, reduced in REDUCED_FLAGS:
+            if min(width, height) // factor >= size:
+                flag = reduced
+                break
+    except (IOError, ValueError) as e:
+        logging.debug("Could not read the image header: {}".format(e))
+    img = cv2.imdecode(np.frombuffer(binary, dtype=np.uint8), flag)
+    if img is None and flag != cv2.IMREAD_COLOR:
+        img = cv2.imdecode(np.frombuffer(binary, dtype=np.uint8),
+                           cv2.IMREAD_COLOR)
+    return img
+
+
+def preprocess(images):
+    """
+    Converts BGR uint8 images of any size to a normalised RGB NCHW batch
+    """
+    batch = np.stack([
+        cv2.resize(img, (IMAGE_SIZE, IMAGE_SIZE),
+                   interpolation=cv2.INTER_AREA)[:, :, ::-1]
+        for img in images]).astype(np.float32) / 255.0
+    batch = (batch - mean) / std
+    return torch.from_numpy(batch.transpose(0, 3, 1, 2).copy())
+
+
+def classify(images):
+    """
+    Classifies a list of BGR images in one batch, returning the class
+    probabilities as a (len(images), 4) tensor
+    """
+    with torch.no_grad():
+        return torch.softmax(model(preprocess(images)), dim=1)
+
+
+# loaded once per worker and shared by every request
+model_ready = False
+model = load_model()
+model_ready = True
+logging.info("Content categoriser loaded")
 
 
 @app.route("/preprocessor", methods=['POST', ])
 def categorise():
     logging.debug("Received request")
     # load the schema
-    labels_dict = {"0": "chart", "1": "photograph", "2": "other", "3": "text"}
     with open('./schemas/preprocessors/content-categoriser.schema.json') \
             as jsonfile:
         data_schema = json.load(jsonfile)
@@ -94,18 +185,15 @@ def categorise():
     source = content["graphic"]
     image_b64 = source.split(",")[1]
     binary = base64.b64decode(image_b64)
-    image = np.asarray(bytearray(binary), dtype="uint8")
-    img = cv2.imdecode(image, cv2.IMREAD_COLOR)
-
-    # download the weights and test the input image. The input image passed to
-    # the "forward" function to get the predictions.
-    net = Net.load_from_checkpoint('./latest-0.ckpt')
-    img = cv2.resize(img, (224, 224))
-    image = img.reshape(1, 3, 224, 224)
-    inputs = torch.FloatTensor(image)
-    net.eval()
-    pred = net(inputs)
-    type = {"category": labels_dict[pred]}
+    img = decode(binary)
+
+    category = cascade.shortcut(img) if CATEGORISER_CASCADE else None
+    if category is None:
+        probabilities = classify([img])[0]
+        category = labels[int(probabilities.argmax())]
+    else:
+        logging.debug("Cascade categorised the graphic as " + category)
+    type = {"category": category}
     try:
         validator = jsonschema.Draft7Validator(data_schema)
         validator.validate(type)
@@ -124,11 +212,19 @@ def categorise():
     except jsonschema.exceptions.ValidationError as e:
         logging.error(e)
         return jsonify("Invalid Preprocessor JSON format"), 500
-    torch.cuda.empty_cache()
     logging.debug("Sending response")
     return response
 
 
+@app.route("/health", methods=['GET'])
+def health():
+    """
+    Reports whether the model has been loaded and warmed up
+    """
+    if model_ready:
+        return jsonify("ready"), 200
+    return jsonify("loading"), 503
+
+
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=5000, debug=True)
-    categorise()
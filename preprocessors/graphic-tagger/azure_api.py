@@ -26,9 +26,14 @@ import logging
 import base64
 import os
 from flask import Flask, request, jsonify
+from image_upload import prepare_upload
 
 app = Flask(__name__)
 
+# Graphics are scaled down to at most this many pixels on their longest
+# side before being uploaded to Azure
+UPLOAD_MAX_SIDE = int(os.environ.get('UPLOAD_MAX_SIDE', 1024))
+
 # extract the required results from the API returned values
 
 
@@ -53,6 +58,7 @@ def process_results(response, labels):
 def process_image(image, labels):
 
     region = "canadacentral"  # For example, "westus"
+    image, _, _ = prepare_upload(image, UPLOAD_MAX_SIDE)
     try:
         api_key = os.environ["AZURE_API_KEY"]
     except Exception as e:
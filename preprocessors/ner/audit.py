@@ -0,0 +1,198 @@
+# Copyright (c) 2022 IMAGE Project, Shared Reality Lab, McGill University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# and our Additional Terms along with this program.
+# If not, see
+# <https://github.com/Shared-Reality-Lab/IMAGE-server/blob/main/LICENSE>.
+#
+# Offline alt-text audit: scores a stream of (image, alt text) pairs with
+# the preprocessor's CLIP model and NER tagger, in batches, and writes
+# one JSON line per pair with the same clipscore/ner/alttxt fields as
+# the preprocessor. The input is either a JSONL file of
+#     {"id": ..., "image": <path or data url>, "alt": ...}
+# lines (paths relative to the file) or a directory of images with a
+# captions.json mapping file stems to alt texts, e.g.
+#     python audit.py crawl.jsonl --output scores.jsonl
+
+import argparse
+import io
+import itertools
+import json
+import logging
+import os
+import queue
+import sys
+import time
+from concurrent.futures import Future
+
+import nltk
+from PIL import Image
+
+import ner
+
+
+def read_jsonl(path):
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path) as f:
+        for n, line in enumerate(f):
+            if not line.strip():
+                continue
+            try:
+                pair = json.loads(line)
+            except ValueError:
+                # reported by audit() like a pair without image or alt
+                yield n, None, None
+                continue
+            if not isinstance(pair, dict):
+                yield n, None, None
+                continue
+            image = pair.get('image')
+            if isinstance(image, str) and not image.startswith('data:'):
+                image = os.path.join(base, image)
+            yield pair.get('id', n), image, pair.get('alt')
+
+
+def read_directory(path):
+    with open(os.path.join(path, 'captions.json')) as f:
+        captions = json.load(f)
+    for file in sorted(os.listdir(path)):
+        stem, ext = os.path.splitext(file)
+        if ext.lower() in ('.png', '.jpg', '.jpeg', '.tiff') \
+                and stem in captions:
+            yield stem, os.path.join(path, file), captions[stem]
+
+
+def load_image(image):
+    if image.startswith('data:'):
+        img = ner.decode_image(image)
+    else:
+        with open(image, 'rb') as f:
+            img = Image.open(io.BytesIO(f.read()))
+    # decode now so a broken file fails here and not in the batch
+    img.load()
+    return img
+
+
+def tag_all(sentences):
+    """
+    Tags every tokenised sentence through the shared tagger, waiting for
+    earlier sentences whenever its queue is full; a sentence that could
+    not be tagged gets the exception instead of its tags
+    """
+    futures = []
+    for words in sentences:
+        while True:
+            try:
+                futures.append(ner.ner_tagger.submit(words))
+                break
+            except queue.Full:
+                pending = [f for f in futures if not f.done()]
+                if pending:
+                    pending[0].exception()
+                else:
+                    time.sleep(0.01)
+            except (OSError, RuntimeError) as e:
+                # the NER server could not be (re)started
+                failed = Future()
+                failed.set_exception(e)
+                futures.append(failed)
+                break
+    return [f.exception() or f.result() for f in futures]
+
+
+def audit(pairs, out, chunk_size=256, image_batch_size=64,
+          text_batch_size=256):
+    """
+    Scores the (id, image, alt) pairs chunk by chunk, writing a JSON line
+    per pair, and returns the number of pairs, errors and pairs skipped
+    for having no alt text (the preprocessor answers those with a 204)
+    """
+    count = errors = skipped = 0
+    pairs = iter(pairs)
+    while True:
+        chunk = list(itertools.islice(pairs, chunk_size))
+        if not chunk:
+            break
+        rows, images, texts = [], [], []
+        for id_, image, text in chunk:
+            if not isinstance(image, str) or not isinstance(text, str):
+                errors += 1
+                out.write(json.dumps({
+                    'id': id_, 'error': "Missing image or alt text"}) + '\n')
+                continue
+            if len(text) < 2:
+                skipped += 1
+                continue
+            try:
+                images.append(load_image(image))
+            except (OSError, ValueError, IndexError) as e:
+                errors += 1
+                out.write(json.dumps({'id': id_, 'error': str(e)}) + '\n')
+                continue
+            rows.append(id_)
+            texts.append(text)
+        if rows:
+            scores = ner.clip_scorer.score_batch(
+                images, texts, image_batch_size, text_batch_size)
+            tagged = tag_all([nltk.word_tokenize(t) for t in texts])
+            for id_, text, score, words in zip(rows, texts, scores, tagged):
+                if isinstance(words, Exception):
+                    errors += 1
+                    out.write(json.dumps({'id': id_, 'error': str(words)})
+                              + '\n')
+                    continue
+                out.write(json.dumps({
+                    'id': id_,
+                    'clipscore': round(float(score), 3),
+                    'ner': ner.ner_objects(text, ner.named_entities(words)),
+                    'alttxt': text}) + '\n')
+        count += len(chunk)
+        out.flush()
+    return count, errors, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Score (image, alt text) pairs with CLIPScore and NER")
+    parser.add_argument('input',
+                        help="JSONL file, or directory with captions.json")
+    parser.add_argument('--output', help="JSONL output (default: stdout)")
+    parser.add_argument('--image-batch-size', type=int, default=64)
+    parser.add_argument('--text-batch-size', type=int, default=256)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if os.path.isdir(args.input):
+        pairs = read_directory(args.input)
+    else:
+        pairs = read_jsonl(args.input)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    start = time.time()
+    try:
+        count, errors, skipped = audit(
+            pairs, out,
+            chunk_size=max(args.image_batch_size, args.text_batch_size),
+            image_batch_size=args.image_batch_size,
+            text_batch_size=args.text_batch_size)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    elapsed = time.time() - start
+    print("{} pairs ({} errors, {} without alt text) in {:.1f}s, "
+          "{:.1f} pairs/s".format(count, errors, skipped, elapsed,
+                                  count / elapsed if elapsed else 0.0),
+          file=sys.stderr)
+    print(json.dumps(ner.clip_scorer.cache_stats()), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
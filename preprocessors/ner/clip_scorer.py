@@ -0,0 +1,123 @@
+# Copyright (c) 2022 IMAGE Project, Shared Reality Lab, McGill University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# and our Additional Terms along with this program.
+# If not, see
+# <https://github.com/Shared-Reality-Lab/IMAGE-server/blob/main/LICENSE>.
+#
+# CLIPScore computed in memory with a resident CLIP model. The captions,
+# preprocessing and scoring are the ones of clipscore.py, without its
+# image directory, JSON files and DataLoader workers.
+
+import logging
+import time
+
+import clip
+import numpy as np
+import torch
+from PIL import Image
+
+from clipscore import CLIPCapDataset, CLIPImageDataset
+from embedding_cache import EmbeddingCache, image_key, text_key
+
+
+def normalize(features):
+    return features / np.sqrt(np.sum(features ** 2, axis=1, keepdims=True))
+
+
+class ClipScorer:
+    """
+    CLIP model loaded once and shared by every request; scores captions
+    against images given as PIL images or RGB arrays
+    """
+    def __init__(self, model_name="ViT-B/32", device='cpu', w=2.5):
+        start = time.time()
+        self.device = device
+        self.w = w
+        self.model, _ = clip.load(model_name, device=device, jit=False)
+        self.model.eval()
+        # only 224x224 ViT-B/32 supported, as in clipscore.py
+        self.preprocess = CLIPImageDataset([]).preprocess
+        self.prefix = CLIPCapDataset([]).prefix
+        # embeddings of the captions and pictures seen before
+        cache_name = model_name.replace('/', '-')
+        self.text_cache = EmbeddingCache(cache_name + '-text')
+        self.image_cache = EmbeddingCache(cache_name + '-image')
+        logging.info("Loaded CLIP {} on {} in {:.2f}s".format(
+            model_name, device, time.time() - start))
+
+    def _cached(self, cache, keys, items, encode, batch_size):
+        # looks every key up and encodes only the missing items, once,
+        # in batches of at most batch_size
+        vectors = [cache.get(key) for key in keys]
+        missing = {}
+        for i, (key, vector) in enumerate(zip(keys, vectors)):
+            if vector is None:
+                missing.setdefault(key, []).append(i)
+        if missing:
+            todo = [items[idx[0]] for idx in missing.values()]
+            encoded = np.concatenate([
+                encode(todo[start:start + batch_size])
+                for start in range(0, len(todo), batch_size)])
+            for (key, idx), vector in zip(missing.items(), encoded):
+                cache.put(key, vector)
+                for i in idx:
+                    vectors[i] = vector
+        return np.stack(vectors)
+
+    def encode_images(self, images, batch_size=64):
+        """
+        Normalised image embeddings, one row per image
+        """
+        images = [Image.fromarray(img) if isinstance(img, np.ndarray)
+                  else img for img in images]
+        return self._cached(self.image_cache,
+                            [image_key(img) for img in images],
+                            images, self._encode_images, batch_size)
+
+    def encode_texts(self, captions, batch_size=256):
+        """
+        Normalised embeddings of the prefixed captions, one row each
+        """
+        return self._cached(self.text_cache,
+                            [text_key(self.prefix, c) for c in captions],
+                            captions, self._encode_texts, batch_size)
+
+    def _encode_images(self, images):
+        batch = torch.stack([self.preprocess(img) for img in images])
+        with torch.no_grad():
+            features = self.model.encode_image(batch.to(self.device))
+        return normalize(features.cpu().float().numpy())
+
+    def _encode_texts(self, captions):
+        tokens = clip.tokenize([self.prefix + c for c in captions],
+                               truncate=True)
+        with torch.no_grad():
+            features = self.model.encode_text(tokens.to(self.device))
+        return normalize(features.cpu().float().numpy())
+
+    def cache_stats(self):
+        return {'text': self.text_cache.stats(),
+                'image': self.image_cache.stats()}
+
+    def score_batch(self, images, captions, image_batch_size=64,
+                    text_batch_size=256):
+        """
+        CLIPScore of each (image, caption) pair; the batch sizes are the
+        defaults of extract_all_images and extract_all_captions
+        """
+        images = self.encode_images(images, image_batch_size)
+        captions = self.encode_texts(captions, text_batch_size)
+        return self.w * np.clip(np.sum(images * captions, axis=1), 0, None)
+
+    def score(self, image, caption):
+        return float(self.score_batch([image], [caption])[0])
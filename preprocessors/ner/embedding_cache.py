@@ -0,0 +1,117 @@
+# Copyright (c) 2022 IMAGE Project, Shared Reality Lab, McGill University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# and our Additional Terms along with this program.
+# If not, see
+# <https://github.com/Shared-Reality-Lab/IMAGE-server/blob/main/LICENSE>.
+
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Entries kept in memory per cache, and an optional directory that
+# evicted entries are written to (and read back from) instead of being
+# dropped
+CLIP_CACHE_SIZE = int(os.environ.get('CLIP_CACHE_SIZE', 4096))
+CLIP_CACHE_DIR = os.environ.get('CLIP_CACHE_DIR')
+
+
+def text_key(prefix, caption):
+    return hashlib.sha1((prefix + caption).encode('utf-8')).hexdigest()
+
+
+def image_key(image):
+    """
+    Hash of the decoded RGB pixels, so the same picture is found again
+    whatever its encoding
+    """
+    pixels = np.asarray(image.convert('RGB'))
+    digest = hashlib.sha1(str(pixels.shape).encode('utf-8'))
+    digest.update(np.ascontiguousarray(pixels).data)
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Bounded LRU cache of embedding vectors with hit/miss counters; with
+    a spill directory, evicted vectors are kept on disk
+    """
+    def __init__(self, name, max_entries=CLIP_CACHE_SIZE,
+                 spill_dir=CLIP_CACHE_DIR):
+        self.name = name
+        self.max_entries = max(0, max_entries)
+        self.spill_dir = None
+        if spill_dir:
+            self.spill_dir = os.path.join(spill_dir, name)
+            os.makedirs(self.spill_dir, exist_ok=True)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.spill_dir, key + '.npy')
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+        if self.spill_dir and os.path.exists(self._path(key)):
+            try:
+                vector = np.load(self._path(key))
+            except (OSError, ValueError) as e:
+                logging.warning(e)
+            else:
+                with self._lock:
+                    self.disk_hits += 1
+                self.put(key, vector)
+                return vector
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, vector):
+        evicted = []
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False))
+        if self.spill_dir:
+            for old_key, old_vector in evicted:
+                path = self._path(old_key)
+                if os.path.exists(path):
+                    continue
+                # written aside first so no reader sees a partial file
+                tmp = "{}.{}.tmp".format(path, os.getpid())
+                with open(tmp, 'wb') as f:
+                    np.save(f, old_vector)
+                os.replace(tmp, path)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / lookups
+                if lookups else 0.0,
+            }
@@ -14,48 +14,39 @@
 # If not, see
 # <https://github.com/Shared-Reality-Lab/IMAGE-server/blob/main/LICENSE>.
 
-import os
+import io
 import json
+import queue
 import time
 import base64
-import shutil
 import logging
-import tempfile
 import jsonschema
+from PIL import Image
 from bs4 import BeautifulSoup
 from flask import Flask, request, jsonify
 
 
 import nltk
-import clipscore
-from nltk.tag.stanford import StanfordNERTagger
+from clip_scorer import ClipScorer
+from tagger import get_tagger
 
 
 nltk.download('punkt')
 app = Flask(__name__)
+# the NER model is loaded once, in a JVM that lives as long as the worker
+ner_tagger = get_tagger()
+# CLIP is loaded once and scores images straight from memory
+clip_scorer = ClipScorer()
 
-# using python's tmp file to store the image and context json
-dir_prefix = 'ner_'
-CONTEXT_DIR = tempfile.mkdtemp(prefix=dir_prefix)
-IMAGE_DIR = tempfile.mkdtemp(prefix=dir_prefix)
 
-# path to the stanford ner models
-STANFORD_JAR = '/app/stanford-ner/stanford-ner.jar'
-STANFORD_MODEL = '/app/stanford-ner/ner-model-english.ser.gz'
-
-
-def save_image(my_html, name, out_dir):
+def decode_image(my_html):
     """
-    Save a html contaning an image to a given location
-    :my_html: the html to save
-    :name: name of the to save
-    :out_dir: directory to save the image to
+    Decode the base64 data url of an image
+    :my_html: the data url of the image
     """
-    path_ = os.path.abspath(f"{out_dir}")
     image_b64 = my_html.split(",")[1]
     binary = base64.b64decode(image_b64)
-    with open(f"{path_}/{name}.png", "wb") as file:
-        file.write(binary)
+    return Image.open(io.BytesIO(binary))
 
 
 def get_alt(my_json):
@@ -69,31 +60,6 @@ def get_alt(my_json):
     return alt
 
 
-class Namespace:
-    """
-    Object to pass parameters to clipscore module
-    """
-    def __init__(self, **kwargs):
-        self.__dict__.update(kwargs)
-
-
-def remove_dirs():
-    """
-    Removes temp dirs created
-    """
-    try:
-        shutil.rmtree(CONTEXT_DIR)
-        logging.info(f"Deleted {str(CONTEXT_DIR)}")
-    except Exception as e:
-        logging.error(e)
-
-    try:
-        shutil.rmtree(IMAGE_DIR)
-        logging.info(f"Deleted {str(IMAGE_DIR)}")
-    except Exception as e:
-        logging.error(e)
-
-
 def stanford_ner(sentence, only_ner=True):
     """
     Function to extarct the NERs from a given english sentence,
@@ -102,24 +68,28 @@ def stanford_ner(sentence, only_ner=True):
     :only_ner: the stanford model also tags pos,
         set the only_ner to only extract the ner tags
     """
-    # Prepare NER tagger with english model
-    ner_tagger = StanfordNERTagger(
-        STANFORD_MODEL, STANFORD_JAR, encoding='utf8')
-
     # Tokenize: Split sentence into words
     words = nltk.word_tokenize(sentence)
 
     # Run NER tagger on words
     words = ner_tagger.tag(words)
     if only_ner:
-        rtn = []
-        for i in words:
-            if len(i[1]) > 4:
-                rtn.append(i)
-        return rtn
+        return named_entities(words)
     return words
 
 
+def named_entities(words):
+    """
+    Keeps the (word, tag) pairs that are named entities
+    :words: tagged words
+    """
+    rtn = []
+    for i in words:
+        if len(i[1]) > 4:
+            rtn.append(i)
+    return rtn
+
+
 def find_first_index(word, arr):
     """
     Given a tuple of strings and their index, the function returns
@@ -135,6 +105,27 @@ def find_first_index(word, arr):
     return -1
 
 
+def ner_objects(text, ners):
+    """
+    Builds the ner objects of the response, with the index of the word
+    each entity was found in
+    :text: the alt text
+    :ners: the (word, tag) pairs of its named entities
+    """
+    arr = text.split()
+    indexed_list = list(zip(arr, range(len(arr))))
+    index = 0
+    ner_data = []
+    for i in ners:
+        my_dict = {}
+        my_dict['value'] = i[0]
+        my_dict['tag'] = i[1]
+        index = find_first_index(i[0], indexed_list[index:]) + 1
+        my_dict['index'] = index
+        ner_data.append(my_dict)
+    return ner_data
+
+
 @app.route('/preprocessor', methods=['POST', 'GET'])
 def main():
     logging.debug("Received request")
@@ -173,54 +164,30 @@ def main():
 
     # check if 'graphic' and 'context' keys are in the content dict
     if 'graphic' in content and 'context' in content:
-        name_ = "1"
-        captions = {}               # dict to store the captions
-        text = get_alt(content)     # extract alt text and save it
-        captions[name_] = text
+        text = get_alt(content)     # extract alt text
         html_ = content['graphic']  # get the image html content
     else:
         logging.info("No 'graphic' or 'context' tag")
         return "", 204
 
-    # save pic and caption to directory for clipscore evaluation
-    with open(CONTEXT_DIR+'/captions.json', "w") as outfile:
-        json.dump(captions, outfile)
-    save_image(html_, name_, IMAGE_DIR)
-
     # check if we have an alt text
     if len(text) < 2:
         logging.info("No alttxt")
         return "", 204
 
-    # create path parameters for clipscore
-    parameters = Namespace(candidates_json=CONTEXT_DIR+'/captions.json',
-                           compute_other_ref_metrics=1,
-                           image_dir=IMAGE_DIR,
-                           references_json=None,
-                           save_per_instance=CONTEXT_DIR+'/score.json')
-
     # calculate the clipscore
-    score = round(clipscore.main(parameters)['1']['CLIPScore'], 3)
+    score = round(clip_scorer.score(decode_image(html_), text), 3)
     # compute the NERs
-    ners = stanford_ner(text)
-
-    # create ner object and add index
-    arr = text.split()
-    indexed_list = list(zip(arr, range(len(arr))))
-    index = 0
-    ner_data = []
-    for i in ners:
-        my_dict = {}
-        my_dict['value'] = i[0]
-        my_dict['tag'] = i[1]
-        index = find_first_index(i[0], indexed_list[index:]) + 1
-        my_dict['index'] = index
-        ner_data.append(my_dict)
+    try:
+        ners = stanford_ner(text)
+    except queue.Full:
+        logging.error("NER queue is full")
+        return jsonify("NER tagger busy"), 503
 
     data = {
         'clipscore': score,
-        'ner': ner_data,
-        'alttxt': captions['1']
+        'ner': ner_objects(text, ners),
+        'alttxt': text
         }
 
     # ------ END COMPUTATION ------ #
@@ -254,7 +221,13 @@ def main():
     return response
 
 
+@app.route('/stats', methods=['GET'])
+def stats():
+    """
+    Hit and miss counters of the CLIP embedding caches
+    """
+    return jsonify(clip_scorer.cache_stats())
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
-    main()
-    remove_dirs()
@@ -0,0 +1,193 @@
+# Copyright (c) 2022 IMAGE Project, Shared Reality Lab, McGill University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# and our Additional Terms along with this program.
+# If not, see
+# <https://github.com/Shared-Reality-Lab/IMAGE-server/blob/main/LICENSE>.
+#
+# Long-lived Stanford NER tagger. The JVM and the CRF model are loaded
+# once, in a NERServer subprocess listening on a local port, which tags
+# the sentences of concurrent requests in parallel.
+
+import logging
+import os
+import queue
+import socket
+import subprocess
+import threading
+import time
+from concurrent.futures import Future
+
+# path to the stanford ner models
+STANFORD_JAR = '/app/stanford-ner/stanford-ner.jar'
+STANFORD_MODEL = '/app/stanford-ner/ner-model-english.ser.gz'
+
+# JVM heap, and how long to wait for the model to load
+NER_JVM_MEMORY = os.environ.get('NER_JVM_MEMORY', '1g')
+NER_STARTUP_TIMEOUT = float(os.environ.get('NER_STARTUP_TIMEOUT', 120))
+# Sentences tagged at once, each over its own connection. At most
+# NER_QUEUE_SIZE sentences wait at once; beyond that submit() raises
+# queue.Full.
+NER_THREADS = int(os.environ.get('NER_THREADS', 4))
+NER_QUEUE_SIZE = int(os.environ.get('NER_QUEUE_SIZE', 64))
+
+_tagger = None
+_lock = threading.Lock()
+
+
+def _free_port():
+    # each worker process runs its own server, so let the OS pick a port
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class NERServer:
+    """
+    A Stanford NERServer JVM that tags whitespace-separated tokens sent
+    over a local socket, one line per connection
+    """
+    def __init__(self, jar=STANFORD_JAR, model=STANFORD_MODEL,
+                 memory=NER_JVM_MEMORY):
+        self.command = [
+            'java', '-mx' + memory, '-cp', jar,
+            'edu.stanford.nlp.ie.NERServer',
+            '-loadClassifier', model,
+            '-outputFormat', 'slashTags',
+            # the tokens come from nltk, so they are only split on spaces
+            '-tokenizerFactory',
+            'edu.stanford.nlp.process.WhitespaceTokenizer',
+            '-tokenizerOptions', 'tokenizeNLs=false',
+            '-encoding', 'utf-8']
+        self.process = None
+        self.port = None
+
+    def start(self, timeout=NER_STARTUP_TIMEOUT):
+        self.port = _free_port()
+        logging.info("Starting NER server on port {}".format(self.port))
+        self.process = subprocess.Popen(
+            self.command + ['-port', str(self.port)],
+            stdout=subprocess.DEVNULL)
+        start = time.time()
+        while True:
+            if self.process.poll() is not None:
+                raise RuntimeError("NER server exited with code {}".format(
+                    self.process.returncode))
+            try:
+                # the first request also warms up the classifier
+                self.tag(['Montreal'])
+                break
+            except OSError:
+                if time.time() - start > timeout:
+                    self.stop()
+                    raise
+                time.sleep(0.5)
+        logging.info("NER server ready in {:.1f}s".format(time.time() - start))
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self):
+        if self.alive():
+            self.process.terminate()
+            self.process.wait()
+
+    def tag(self, words):
+        """
+        Returns the (word, tag) pairs of a list of tokens
+        """
+        line = ' '.join(words).replace('\n', ' ') + '\n'
+        with socket.create_connection(('127.0.0.1', self.port)) as s:
+            s.sendall(line.encode('utf-8'))
+            s.shutdown(socket.SHUT_WR)
+            chunks = []
+            while True:
+                chunk = s.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        tagged = b''.join(chunks).decode('utf-8').split()
+        pairs = [tuple(token.rsplit('/', 1)) for token in tagged]
+        if len(pairs) != len(words) or any(len(p) != 2 for p in pairs):
+            raise RuntimeError("Unexpected NER server output")
+        return pairs
+
+
+class _Request:
+    def __init__(self, words):
+        self.words = words
+        self.future = Future()
+
+
+class NERTagger:
+    """
+    Tags sentences with a persistent NERServer. Each sentence is sent on
+    its own connection, as in a per-sentence call to the tagger, so its
+    tags never depend on the other sentences being tagged at the time;
+    NER_THREADS connections are served concurrently.
+    """
+    def __init__(self, server=None, threads=NER_THREADS,
+                 queue_size=NER_QUEUE_SIZE):
+        self.server = server or NERServer()
+        self.threads = max(1, int(threads))
+        self._queue = queue.Queue(maxsize=max(0, queue_size))
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def submit(self, words):
+        """
+        Queues a tokenised sentence and returns a future resolving to its
+        (word, tag) pairs; raises queue.Full when too many are waiting
+        """
+        self._ensure_worker()
+        req = _Request(list(words))
+        self._queue.put_nowait(req)
+        return req.future
+
+    def tag(self, words, timeout=None):
+        return self.submit(words).result(timeout)
+
+    def _ensure_worker(self):
+        with self._lock:
+            if not self.server.alive():
+                if self.server.process is not None:
+                    logging.warning("NER server died, restarting it")
+                self.server.start()
+            self._workers = [t for t in self._workers if t.is_alive()]
+            while len(self._workers) < self.threads:
+                thread = threading.Thread(
+                    target=self._loop, name='ner-tagger', daemon=True)
+                thread.start()
+                self._workers.append(thread)
+
+    def _loop(self):
+        while True:
+            req = self._queue.get()
+            try:
+                tagged = self.server.tag(req.words) if req.words else []
+            except Exception as e:
+                logging.error(e)
+                req.future.set_exception(e)
+                continue
+            req.future.set_result(tagged)
+
+
+def get_tagger():
+    """
+    Returns the process-wide tagger, starting its server on first use
+    """
+    global _tagger
+    with _lock:
+        if _tagger is None:
+            _tagger = NERTagger()
+            _tagger._ensure_worker()
+    return _tagger
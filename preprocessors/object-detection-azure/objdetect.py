@@ -23,9 +23,14 @@ import logging
 import base64
 import os
 from flask import Flask, request, jsonify
+from image_upload import prepare_upload
 
 app = Flask(__name__)
 
+# Graphics are scaled down to at most this many pixels on their longest
+# side before being uploaded to Azure
+UPLOAD_MAX_SIDE = int(os.environ.get('UPLOAD_MAX_SIDE', 1024))
+
 # load the schema
 with open('./schemas/preprocessors/object-detection.schema.json') \
         as jsonfile:
@@ -73,6 +78,10 @@ def process_image(image):
 
     region = "canadacentral"  # For example, "westus"
 
+    # the boxes are normalised by the size Azure reports for the uploaded
+    # graphic, so they stay correct after it is scaled down
+    image, _, _ = prepare_upload(image, UPLOAD_MAX_SIDE)
+
     try:
         api_key = os.environ["AZURE_API_KEY"]
     except Exception as e:
@@ -0,0 +1,146 @@
+# Copyright (c) 2021 IMAGE Project, Shared Reality Lab, McGill University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# and our Additional Terms along with this program.
+# If not, see
+# <https://github.com/Shared-Reality-Lab/IMAGE-server/blob/main/LICENSE>.
+#
+# Asynchronous client for Azure's Read API. Every request handled by a
+# worker shares one event loop and one pooled HTTP session, so many
+# operations can be in flight at once while their results are polled.
+
+import asyncio
+import logging
+import os
+import threading
+import time
+
+import aiohttp
+
+# Time allowed for a whole Read operation, and the bounds of the
+# interval between two polls of its result
+OCR_DEADLINE_S = float(os.environ.get('OCR_DEADLINE_S', 10))
+OCR_POLL_MIN_S = float(os.environ.get('OCR_POLL_MIN_S', 0.1))
+OCR_POLL_MAX_S = float(os.environ.get('OCR_POLL_MAX_S', 2))
+OCR_MAX_CONNECTIONS = int(os.environ.get('OCR_MAX_CONNECTIONS', 32))
+
+_clients = {}
+_lock = threading.Lock()
+
+
+class AzureReadClient:
+    """
+    Submits images to the Read API and polls for their results, waiting
+    a little less than the usual completion time before the first poll
+    and backing off exponentially after that
+    """
+    def __init__(self, endpoint, key, deadline=OCR_DEADLINE_S,
+                 min_interval=OCR_POLL_MIN_S, max_interval=OCR_POLL_MAX_S,
+                 max_connections=OCR_MAX_CONNECTIONS):
+        self.url = endpoint + "vision/v3.2/read/analyze"
+        self.key = key
+        self.deadline = deadline
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_connections = max_connections
+        # moving average of how long operations take to complete (s)
+        self.expected = 1.0
+        self._loop = None
+        self._session = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self):
+        # the loop thread is started lazily so that it is created in the
+        # process that actually serves requests
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever,
+                                 name='azure-read', daemon=True).start()
+        return self._loop
+
+    async def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers={'Ocp-Apim-Subscription-Key': self.key},
+                connector=aiohttp.TCPConnector(limit=self.max_connections))
+        return self._session
+
+    def _record(self, seconds):
+        self.expected = 0.8 * self.expected + 0.2 * seconds
+
+    async def read_async(self, binary, deadline=None):
+        """
+        Returns the JSON result of a Read operation on the image, or
+        None if it failed or did not finish before the deadline
+        """
+        deadline = self.deadline if deadline is None else deadline
+        start = time.monotonic()
+        session = await self._get_session()
+        try:
+            async with session.post(
+                    self.url, data=binary,
+                    headers={'Content-Type': 'application/octet-stream'},
+                    timeout=aiohttp.ClientTimeout(total=deadline)) as resp:
+                resp.raise_for_status()
+                location = resp.headers['Operation-Location']
+
+            delay = max(self.min_interval, 0.5 * self.expected)
+            while True:
+                remaining = deadline - (time.monotonic() - start)
+                if remaining <= 0:
+                    logging.error("Azure request timed out after {}s".format(
+                        deadline))
+                    return None
+                await asyncio.sleep(min(delay, remaining))
+                async with session.get(
+                        location,
+                        timeout=aiohttp.ClientTimeout(
+                            total=max(remaining, self.min_interval))) as resp:
+                    resp.raise_for_status()
+                    retry_after = resp.headers.get('Retry-After')
+                    result = await resp.json()
+                if result['status'] not in ['notStarted', 'running']:
+                    break
+                delay = min(delay * 2, self.max_interval)
+                if retry_after and retry_after.isdigit():
+                    delay = max(delay, float(retry_after))
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError) as e:
+            logging.error("Azure request failed: {}".format(e))
+            return None
+
+        elapsed = time.monotonic() - start
+        self._record(elapsed)
+        logging.debug("Read operation {} in {:.2f}s".format(
+            result['status'], elapsed))
+        if result['status'] != 'succeeded':
+            logging.error("OCR text: {}".format(result['status']))
+            return None
+        return result
+
+    def read(self, binary, deadline=None):
+        """
+        Blocking wrapper around read_async for the Flask handlers
+        """
+        future = asyncio.run_coroutine_threadsafe(
+            self.read_async(binary, deadline), self._ensure_loop())
+        return future.result()
+
+
+def get_client(endpoint, key):
+    """
+    Returns the process-wide client for the given endpoint
+    """
+    with _lock:
+        if (endpoint, key) not in _clients:
+            _clients[(endpoint, key)] = AzureReadClient(endpoint, key)
+    return _clients[(endpoint, key)]
@@ -0,0 +1,90 @@
+# Copyright (c) 2021 IMAGE Project, Shared Reality Lab, McGill University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# and our Additional Terms along with this program.
+# If not, see
+# <https://github.com/Shared-Reality-Lab/IMAGE-server/blob/main/LICENSE>.
+#
+# Local OCR with Tesseract, run on a pool of worker threads shared by
+# every request of the process
+
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytesseract
+from PIL import Image
+
+from ocr_utils import normalize_bdg_box
+
+# Number of images recognised at once, and the Tesseract language(s)
+OCR_LOCAL_WORKERS = int(os.environ.get('OCR_LOCAL_WORKERS', 2))
+OCR_LOCAL_LANG = os.environ.get('OCR_LOCAL_LANG', 'eng')
+
+_pool = None
+_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=OCR_LOCAL_WORKERS,
+                                       thread_name_prefix='tesseract')
+    return _pool
+
+
+def _recognise(binary):
+    image = Image.open(io.BytesIO(binary))
+    return pytesseract.image_to_data(
+        image, lang=OCR_LOCAL_LANG, output_type=pytesseract.Output.DICT)
+
+
+def process_local(binary, width, height):
+    """
+    Returns the lines of text found by Tesseract, with normalized
+    bounding boxes, and their mean confidence (0-100)
+    """
+    try:
+        data = get_pool().submit(_recognise, binary).result()
+    except (OSError, RuntimeError, pytesseract.TesseractError) as e:
+        logging.error("Local OCR failed: {}".format(e))
+        return None, 0.0
+
+    # group the recognised words by line
+    lines = {}
+    for i, text in enumerate(data['text']):
+        conf = float(data['conf'][i])
+        if conf < 0 or not text.strip():
+            continue
+        key = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+        lines.setdefault(key, []).append(i)
+
+    ocr_results = []
+    confidences = []
+    for words in lines.values():
+        left = min(data['left'][i] for i in words)
+        top = min(data['top'][i] for i in words)
+        right = max(data['left'][i] + data['width'][i] for i in words)
+        bottom = max(data['top'][i] + data['height'][i] for i in words)
+        bounding_box = normalize_bdg_box([left, top, right, bottom],
+                                         width, height)
+        ocr_results.append({
+            'text': ' '.join(data['text'][i] for i in words),
+            'bounding_box': bounding_box
+        })
+        confidences.append(
+            sum(float(data['conf'][i]) for i in words) / len(words))
+    confidence = sum(confidences) / len(confidences) if confidences else 0.0
+    return ocr_results, confidence
@@ -31,9 +31,21 @@ from ocr_utils import (
     find_obj_enclosing,
     process_azure_read_v4_preview
 )
+from local_ocr import process_local
+from image_upload import prepare_upload
 
 app = Flask(__name__)
 
+# With CLOUD_SERVICE="LOCAL", images whose mean line confidence is below
+# OCR_LOCAL_MIN_CONFIDENCE (0-100) are sent again to the cloud service
+# named by OCR_ESCALATION_SERVICE, if set
+OCR_ESCALATION_SERVICE = os.environ.get('OCR_ESCALATION_SERVICE', '')
+OCR_LOCAL_MIN_CONFIDENCE = float(
+    os.environ.get('OCR_LOCAL_MIN_CONFIDENCE', 80))
+# Graphics are scaled down to at most this many pixels on their longest
+# side before being uploaded to a cloud service
+UPLOAD_MAX_SIDE = int(os.environ.get('UPLOAD_MAX_SIDE', 3200))
+
 
 @app.route('/preprocessor', methods=['POST', 'GET'])
 def get_ocr_text():
@@ -84,10 +96,11 @@ def get_ocr_text():
 
     cld_srv_optn = os.environ["CLOUD_SERVICE"]
 
-    ocr_result = analyze_image(content['graphic'], width, height, cld_srv_optn)
+    ocr_result, engine = recognise(
+        content['graphic'], width, height, cld_srv_optn)
 
     if ocr_result is None:
-        return jsonify("Could not retreive Azure results"), 500
+        return jsonify("Could not retreive OCR results"), 500
 
     od = 'ca.mcgill.a11y.image.preprocessor.objectDetection'
     preprocessors = content['preprocessors']
@@ -97,7 +110,7 @@ def get_ocr_text():
     name = 'ca.mcgill.a11y.image.preprocessor.ocrClouds'
     request_uuid = content['request_uuid']
     timestamp = int(time.time())
-    data = {'lines': ocr_result, 'cloud_service': cld_srv_optn}
+    data = {'lines': ocr_result, 'cloud_service': engine}
 
     try:
         validator = jsonschema.Draft7Validator(data_schema, resolver=resolver)
@@ -124,15 +137,41 @@ def get_ocr_text():
     return response
 
 
+def recognise(source, width, height, cld_srv_optn):
+    """
+    Runs OCR with the configured engine and returns the lines along with
+    the name of the engine that produced them
+    """
+    if cld_srv_optn != "LOCAL":
+        return analyze_image(source, width, height, cld_srv_optn), \
+            cld_srv_optn
+
+    binary = base64.b64decode(source.split(",")[1])
+    ocr_result, confidence = process_local(binary, width, height)
+    if OCR_ESCALATION_SERVICE and \
+            (ocr_result is None or confidence < OCR_LOCAL_MIN_CONFIDENCE):
+        logging.info("Local OCR confidence {:.1f}, using {}".format(
+            confidence, OCR_ESCALATION_SERVICE))
+        return analyze_image(source, width, height,
+                             OCR_ESCALATION_SERVICE), OCR_ESCALATION_SERVICE
+    return ocr_result, "LOCAL"
+
+
 def analyze_image(source, width, height, cld_srv_optn):
     """
     Gets OCR text data from desired API
     """
 
-    # Convert URI to binary stream
+    # Convert URI to binary stream, shrunk for the upload
     image_b64 = source.split(",")[1]
     binary = base64.b64decode(image_b64)
-    stream = io.BytesIO(binary)
+    data, mime, scale = prepare_upload(binary, UPLOAD_MAX_SIDE)
+    if data is not binary:
+        image_b64 = base64.b64encode(data).decode()
+        source = "data:{};base64,{}".format(mime, image_b64)
+    # the boxes returned are in the uploaded graphic's pixels
+    width, height = width * scale, height * scale
+    stream = io.BytesIO(data)
 
     if cld_srv_optn == "AZURE_READ":
         return process_azure_read(stream, width, height)
@@ -14,14 +14,12 @@
 # If not, see
 # <https://github.com/Shared-Reality-Lab/IMAGE-server/blob/main/LICENSE>.
 
-import time
 import logging
 import os
+import numpy as np
 import requests
-from azure.cognitiveservices.vision.computervision import ComputerVisionClient
-from azure.cognitiveservices.vision.computervision.models import OperationStatusCodes # noqa
-from msrest.authentication import CognitiveServicesCredentials
 from google.cloud import vision
+from async_ocr import get_client
 
 # Pull key value and declare endpoint for Azure OCR API
 azure_subscr_key = os.environ["AZURE_API_KEY"]
@@ -31,49 +29,32 @@ azure_endpoint = "https://image-cv.cognitiveservices.azure.com/"
 freeocr_subscription_key = os.environ["FREEOCR_API_KEY"]
 freeocr_endpoint = "https://api.ocr.space/parse/image"
 
+# OCR lines tested against the object boxes at a time
+CONTAINMENT_CHUNK = 4096
 
-def process_azure_read(stream, width, height):
-    computervision_client = ComputerVisionClient(
-        azure_endpoint, CognitiveServicesCredentials(azure_subscr_key))
-    read_response = computervision_client.read_in_stream(stream,  raw=True)
-
-    read_operation_location = read_response.headers["Operation-Location"]
-    # Grab the ID from the URL
-    operation_id = read_operation_location.split("/")[-1]
-
-    # Call the "GET" API and wait for it to
-    # retrieve the results barring timeout
 
-    start_time = time.time()
-
-    while True:
-        read_result = computervision_client.get_read_result(operation_id)
-        if read_result.status not in ['notStarted', 'running']:
-            break
-        if time.time() - start_time > 3:
-            logging.error("Azure request timed out")
-            return None
-        time.sleep(1)
-
-    # Check for success
-    if read_result.status == OperationStatusCodes.succeeded:
-        ocr_results = []
-        for region in read_result.analyze_result.read_results:
-            for line in region.lines:
-                line_text = line.text
-                # Get normalized bounding box for each line
-                bbx = line.bounding_box
-                bg_bx = [bbx[0], bbx[1], bbx[4], bbx[5]]
-                bounding_box = normalize_bdg_box(bg_bx, width, height)
-                ocr_results.append({
-                    'text': line_text,
-                    'bounding_box': bounding_box
-                })
-        return ocr_results
-    else:
-        logging.error("OCR text: {}".format(read_result.status))
+def process_azure_read(stream, width, height):
+    # Submit the image and poll for the result without blocking the
+    # other requests served by this worker
+    read_result = get_client(azure_endpoint, azure_subscr_key).read(
+        stream.read())
+    if read_result is None:
         return None
 
+    ocr_results = []
+    for region in read_result['analyzeResult']['readResults']:
+        for line in region['lines']:
+            line_text = line['text']
+            # Get normalized bounding box for each line
+            bbx = line['boundingBox']
+            bg_bx = [bbx[0], bbx[1], bbx[4], bbx[5]]
+            bounding_box = normalize_bdg_box(bg_bx, width, height)
+            ocr_results.append({
+                'text': line_text,
+                'bounding_box': bounding_box
+            })
+    return ocr_results
+
 
 def process_azure_read_v4_preview(stream, width, height):
     headers = {
@@ -210,62 +191,36 @@ def normalize_bdg_box(bndng_bx, width, height):
 
 
 def find_obj_enclosing(prepr_name, list_data, ocr_lines):
-    objs = [{key: obj[key] for key
-             in ['ID', 'dimensions']} for
-            obj in list_data['objects']]
-    for line in ocr_lines:
-        obj_enclosing = [
-            obj for obj in objs if is_contained(get_dims(line), get_dims(obj))
-        ]
-        if len(obj_enclosing) > 0:
-            oid_dim = {obj['ID']: get_area(obj) for obj in obj_enclosing}
+    """
+    Adds to each line the ID of the smallest object enclosing it, with
+    every line tested against every object box at once
+    """
+    objs = list_data['objects']
+    if not objs or not ocr_lines:
+        return ocr_lines
+    boxes = np.array([obj['dimensions'] for obj in objs], dtype=np.float64)
+    areas = np.array([get_area(obj) for obj in objs])
+    lines = np.array([line['bounding_box'] for line in ocr_lines],
+                     dtype=np.float64)
+    # lines are compared in chunks to bound the size of the n x m masks
+    for start in range(0, len(lines), CONTAINMENT_CHUNK):
+        chunk = lines[start:start + CONTAINMENT_CHUNK, None, :]
+        contained = (chunk[..., 0] >= boxes[:, 0]) \
+            & (chunk[..., 1] >= boxes[:, 1]) \
+            & (chunk[..., 2] <= boxes[:, 2]) \
+            & (chunk[..., 3] <= boxes[:, 3])
+        smallest = np.where(contained, areas, np.inf).argmin(axis=1)
+        for i in np.flatnonzero(contained.any(axis=1)):
+            line = ocr_lines[start + i]
             if 'enclosed_by' not in line.keys():
                 line['enclosed_by'] = []
             line['enclosed_by'].append({
                 'preprocessor': prepr_name,
-                'ID': min(oid_dim, key=oid_dim.get)
+                'ID': objs[smallest[i]]['ID']
             })
     return ocr_lines
 
 
-def get_dims(obj):
-    """
-    Returns a dict with [ulx, uly, lrx, lry]
-    of the object box
-    """
-    # If the object is not a region of text
-    # its bounding box is called "dimensions"
-    # so the key is set accordingly
-    if "dimensions" in obj:
-        key = "dimensions"
-    # Otherwise, the key is "bounding_box"
-    # for regions of text
-    else:
-        key = "bounding_box"
-    obj_box = {
-        'ulx': obj[key][0],  # x - left edge
-        'uly': obj[key][1],  # y - top edge
-        'lrx': obj[key][2],  # x - right edge
-        'lry': obj[key][3]   # y - bottom edge
-    }
-    return obj_box
-
-
-def is_contained(text_dims, obj_dims):
-    """
-    Checks if text is contained in object
-    """
-    if text_dims['ulx'] < obj_dims['ulx']:
-        return False
-    if text_dims['uly'] < obj_dims['uly']:
-        return False
-    if text_dims['lrx'] > obj_dims['lrx']:
-        return False
-    if text_dims['lry'] > obj_dims['lry']:
-        return False
-    return True
-
-
 def get_area(obj):
     """
     Returns the area
@@ -280,4 +235,5 @@ def get_area(obj):
     # for regions of text
     else:
         key = "bounding_box"
-    return obj[key][2] * obj[key][3]
+    x1, y1, x2, y2 = obj[key][:4]
+    return (x2 - x1) * (y2 - y1)
@@ -154,100 +154,56 @@ def process_streets_data(OSM_data, bbox_coordinates):
         return processed_OSM_data
 
 
-def compare_street(street1, street2):  # Compare two streets
-    intersecting_points = [x for x in street1 if x in street2]
-    return intersecting_points
-
-
-def extract_street(processed_OSM_data):  # extract two streets
-    intersection_record = []
-    for i in range(len(processed_OSM_data)):
-        for j in range(i + 1, len(processed_OSM_data)):
-            street1 = processed_OSM_data[i]["nodes"]
-            street2 = processed_OSM_data[j]["nodes"]
-            intersecting_points = compare_street(
-                street1, street2)  # function call
-            if len(intersecting_points):  # check if not empty
-                if "street_name" in processed_OSM_data[i]:
-                    street_object = {
-                        "street_id": processed_OSM_data[i]["street_id"],
-                        "street_name": processed_OSM_data[i]["street_name"],
-                        "intersection_nodes": intersecting_points,
-                    }
-                elif "street_type" in processed_OSM_data[i]:
-                    street_object = {
-                        "street_id": processed_OSM_data[i]["street_id"],
-                        "street_type": processed_OSM_data[i]["street_type"],
-                        "intersection_nodes": intersecting_points,
-                    }
-                else:
-                    street_object = {
-                        "street_id": processed_OSM_data[i]["street_id"],
-                        "intersection_nodes": intersecting_points,
-                    }
-                intersection_record.append(street_object)
-                if "street_name" in processed_OSM_data[j]:
-                    street_object = {
-                        "street_id": processed_OSM_data[j]["street_id"],
-                        "street_name": processed_OSM_data[j]["street_name"],
-                        "intersection_nodes": intersecting_points,
-                    }
-                elif "street_type" in processed_OSM_data[i]:
-                    street_object = {
-                        "street_id": processed_OSM_data[i]["street_id"],
-                        "street_type": processed_OSM_data[i]["street_type"],
-                        "intersection_nodes": intersecting_points,
-                    }
-                else:
-                    street_object = {
-                        "street_id": processed_OSM_data[j]["street_id"],
-                        "intersection_nodes": intersecting_points,
-                    }
-                intersection_record.append(street_object)
-    # Group the streets by their ids
-    output = {}
-    for obj in intersection_record:
-        street_id = obj["street_id"]
-        if street_id not in output:
-            assert obj["intersection_nodes"] is not None
-            if "street_name" in obj:
-                record = {
-                    "street_id": obj["street_id"],
-                    "street_name": obj["street_name"],
-                    "intersection_nodes": obj["intersection_nodes"],
-                }
-            elif "street_type" in obj:
-                record = {
-                    "street_id": obj["street_id"],
-                    "street_type": obj["street_type"],
-                    "intersection_nodes": obj["intersection_nodes"],
-                }
-            else:
-                record = {
-                    "street_id": obj["street_id"],
-                    "intersection_nodes": obj["intersection_nodes"],
-                }
-            output[street_id] = record
-        else:
-            existing_record = output[street_id]
-            existing_intersection_nodes = existing_record["intersection_nodes"]
-            assert existing_intersection_nodes is not None
-            new_intersection_nodes = obj["intersection_nodes"]
-            q = new_intersection_nodes
-            assert q is not None
-            merged_intersection_nodes = existing_intersection_nodes + q
-            existing_record["intersection_nodes"] = merged_intersection_nodes
-            output[street_id] = existing_record
-    intersection_record_updated = list(output.values())
-    # Keep a unique set of intersections under each street segment
-    for obj in range(len(intersection_record_updated)):
-        unique_set = []
-        inter_sets = intersection_record_updated[obj]["intersection_nodes"]
-        unique_set = [item for item in inter_sets if item not in unique_set]
-        # for item in range(len(inter_sets)):
-        # if inter_sets[item] not in unique_set:
-        # unique_set.append(inter_sets[item])
-        intersection_record_updated[obj]["intersection_nodes"] = unique_set
+def extract_street(processed_OSM_data):  # extract intersecting streets
+    """
+    Lists, for every street that crosses another one, the nodes it
+    shares with other streets. Streets are indexed by node so that each
+    street's nodes are only walked once. Every intersecting street gets
+    a record of its own, including unnamed streets that share nodes
+    with a street listed before them.
+    """
+    node_ids = [{node["id"] for node in street["nodes"]}
+                for street in processed_OSM_data]
+    # map every node to the streets it belongs to
+    node_streets = {}
+    for index, ids in enumerate(node_ids):
+        for node_id in ids:
+            node_streets.setdefault(node_id, []).append(index)
+    neighbours = [set() for _ in processed_OSM_data]
+    for streets in node_streets.values():
+        if len(streets) > 1:
+            for index in streets:
+                neighbours[index].update(streets)
+    for index, others in enumerate(neighbours):
+        others.discard(index)
+
+    def first_pair(index):
+        # streets are listed in the order in which a scan of every pair
+        # of streets would first find them intersecting
+        earlier = [other for other in neighbours[index] if other < index]
+        if earlier:
+            return (min(earlier), index, 1)
+        return (index, min(neighbours[index]), 0)
+
+    intersection_record_updated = []
+    intersecting = [i for i in range(len(processed_OSM_data)) if neighbours[i]]
+    for index in sorted(intersecting, key=first_pair):
+        street = processed_OSM_data[index]
+        # the street's own nodes that belong to another street too
+        seen = set()
+        intersection_nodes = []
+        for node in street["nodes"]:
+            if len(node_streets[node["id"]]) > 1 \
+                    and node["id"] not in seen:
+                seen.add(node["id"])
+                intersection_nodes.append(node)
+        record = {"street_id": street["street_id"]}
+        if "street_name" in street:
+            record["street_name"] = street["street_name"]
+        elif "street_type" in street:
+            record["street_type"] = street["street_type"]
+        record["intersection_nodes"] = intersection_nodes
+        intersection_record_updated.append(record)
     return (intersection_record_updated)
 
 
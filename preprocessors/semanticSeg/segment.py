@@ -19,10 +19,11 @@
 # Lines 99-102 are refered form
 # https://gist.github.com/daino3/b671b2d171b3948692887e4c484caf47
 
+import argparse
+import contextlib
 import csv
+import os
 import torch
-import numpy
-import scipy.io
 import torchvision.transforms
 from flask import Flask, request, jsonify
 import json
@@ -33,16 +34,10 @@ import base64
 import cv2
 import numpy as np
 from mit_semseg.models import ModelBuilder, SegmentationModule
-from mit_semseg.utils import colorEncode
-import gc
 
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.NOTSET)
-# assigns different colors to different segments. This helps in
-# determining contour or different segments. Refer Line 136 to see how
-# unique color helps in contour determination
-colors = scipy.io.loadmat('data/color150.mat')['colors']
 names = {}
 with open('data/object150_info.csv') as f:
     reader = csv.reader(f)
@@ -51,87 +46,212 @@ with open('data/object150_info.csv') as f:
         names[int(row[0])] = row[5].split(";")[0]
 
 
-# Removes the remaining segments and only highlights the segment of
-# interest with a particular color.
-def visualize_result(img, pred, index=None):
-    if index is not None:
-        pred = pred.copy()
-        pred[pred != index] = -1
-    pred_color = colorEncode(pred, colors).astype(numpy.uint8)
-    nameofobj = names[index + 1]
-    return pred_color, nameofobj
+# Execution settings. TORCH_DEVICE defaults to the GPU when there is one.
+# On CPU, SEG_THREADS sets the intra-op thread count and SEG_BF16=1 runs
+# inference under bfloat16 autocast. SEG_MAX_SIDE is the longest side
+# images are scaled down to before inference.
+device = torch.device(os.environ.get(
+    "TORCH_DEVICE", "cuda" if torch.cuda.is_available() else "cpu"))
+SEG_THREADS = int(os.environ.get("SEG_THREADS", 0))
+SEG_BF16 = os.environ.get("SEG_BF16", "0") == "1"
+SEG_MAX_SIDE = int(os.environ.get("SEG_MAX_SIDE", 1500))
+# Contour simplification. SEG_SIMPLIFY_TOLERANCE is the Douglas-Peucker
+# tolerance as a fraction of the image diagonal, SEG_MAX_POINTS caps the
+# points of a single contour (simplifying it further than the tolerance)
+# and SEG_MAX_TOTAL_POINTS the points of the whole response; the
+# tolerance is doubled until the response fits (0 disables either cap).
+SEG_SIMPLIFY_TOLERANCE = float(
+    os.environ.get("SEG_SIMPLIFY_TOLERANCE", 0.001))
+SEG_MAX_POINTS = int(os.environ.get("SEG_MAX_POINTS", 1000))
+SEG_MAX_TOTAL_POINTS = int(os.environ.get("SEG_MAX_TOTAL_POINTS", 10000))
+if device.type == 'cpu' and SEG_THREADS > 0:
+    torch.set_num_threads(SEG_THREADS)
+# channels_last is faster for the ResNet convolutions on CPU
+memory_format = torch.channels_last if device.type == 'cpu' \
+    else torch.contiguous_format
 
-# takes the colored segment(determined in visualise_reslt function and
-# compressed the segment to 100 pixels
 
+def autocast():
+    # bfloat16 autocast is only ever built for CPU: torch 1.10 rejects a
+    # bfloat16 CUDA autocast on older GPUs, even a disabled one
+    if SEG_BF16 and device.type == 'cpu':
+        return torch.autocast('cpu', dtype=torch.bfloat16)
+    return contextlib.nullcontext()
 
-def findContour(pred_color, width, height):
-    image = pred_color
-    dummy = pred_color.copy()
-    gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    ret, thresh = cv2.threshold(gray_image, 10, 255, cv2.THRESH_BINARY)
+
+class StageTimer:
+    """
+    Accumulates the wall time (ms) spent in each stage into a dict;
+    does nothing when no dict is given
+    """
+    def __init__(self, timings=None):
+        self.timings = timings
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        if self.timings is None:
+            return
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.timings[stage] = \
+            self.timings.get(stage, 0.0) + (now - self.last) * 1000
+        self.last = now
+
+
+def load_segmentation_module():
+    """
+    Builds the ResNet50-dilated/PPM network, loads its weights and moves
+    it to the configured device in eval mode
+    """
+    net_encoder = ModelBuilder.build_encoder(
+        arch='resnet50dilated',
+        fc_dim=2048,
+        weights='encoder_epoch_20.pth')
+    net_decoder = ModelBuilder.build_decoder(
+        arch='ppm_deepsup',
+        fc_dim=2048,
+        num_class=150,
+        weights='decoder_epoch_20.pth',
+        use_softmax=True)
+    crit = torch.nn.NLLLoss(ignore_index=-1)
+    module = SegmentationModule(net_encoder, net_decoder, crit)
+    module.eval()
+    module.to(device, memory_format=memory_format)
+    return module
+
+
+def warmup(module, size=256):
+    """
+    Runs a dummy image through the network so that the first request
+    does not pay for lazy initialisation
+    """
+    dummy = torch.zeros(1, 3, size, size).to(
+        device, memory_format=memory_format)
+    with torch.no_grad(), autocast():
+        module({'img_data': dummy}, segSize=(size, size))
+
+
+# the network is built once per worker and reused by every request
+pil_to_tensor = torchvision.transforms.Compose([
+    torchvision.transforms.ToTensor(),
+    torchvision.transforms.Normalize(
+        mean=[0.485, 0.456, 0.406],
+        std=[0.229, 0.224, 0.225])
+])
+model_ready = False
+segmentation_module = load_segmentation_module()
+warmup(segmentation_module)
+model_ready = True
+logging.info("Segmentation model loaded on {}".format(device))
+
+
+def rank_classes(pred, k=5):
+    """
+    The k most frequent classes of a label map, counted on its device
+    """
+    counts = torch.bincount(pred.flatten(), minlength=150)
+    counts, classes = counts.topk(k)
+    return classes[counts > 0]
+
+
+def class_masks(pred, classes):
+    """
+    Binary uint8 masks (one per class) built from the label map on its
+    device; only the bit-packed masks are copied back to the host
+    """
+    masks = (pred[None, :, :] == classes[:, None, None]).to(torch.uint8)
+    n, height, width = masks.shape
+    # pad each row to whole bytes, then pack 8 pixels per byte
+    masks = torch.nn.functional.pad(masks, (0, -width % 8))
+    bits = torch.tensor([128, 64, 32, 16, 8, 4, 2, 1],
+                        dtype=torch.uint8, device=pred.device)
+    packed = (masks.view(n, height, -1, 8) * bits).sum(-1, dtype=torch.uint8)
+    masks = np.unpackbits(packed.cpu().numpy(), axis=-1)
+    return np.ascontiguousarray(masks[..., :width])
+
+
+def simplify(contour, epsilon, max_points=SEG_MAX_POINTS):
+    """
+    Douglas-Peucker simplification of a closed contour with a tolerance
+    of epsilon pixels, coarsened further if it still has more than
+    max_points points
+    """
+    # a polygon cannot get much simpler than a quadrilateral, so an
+    # approximation with fewer points is dropped for the one at half the
+    # tolerance, as at the previous step of the budget loop
+    if epsilon > 0:
+        approx = cv2.approxPolyDP(contour, epsilon, True)
+        while len(approx) < 4 and epsilon >= 1.0:
+            epsilon /= 2
+            approx = cv2.approxPolyDP(contour, epsilon, True)
+        if len(approx) >= 4:
+            contour = approx
+    epsilon = max(epsilon, 1.0)
+    while max_points > 0 and len(contour) > max(max_points, 4):
+        approx = cv2.approxPolyDP(contour, epsilon, True)
+        if len(approx) < 4:
+            break
+        contour = approx
+        epsilon *= 1.5
+    return contour
+
+
+# extracts the external contours of one class mask along with their
+# normalised centroids and areas, at full resolution
+def findContour(mask, width, height):
     contours, hierarchy = cv2.findContours(
-        thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
-    cv2.drawContours(image, contours, -1, (0, 255, 0), 2)
-    # removes the remaining part of image and keeps the contours of segments
-    image = image - dummy
+        mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
     centres = []
     area = []
-    totArea = 0
-    send_contour = []
-    flag = False
+    found = []
     # calculate the centre and area of individual contours
-    for i in range(len(contours)):
-        moments = cv2.moments(contours[i])
+    for contour in contours:
+        moments = cv2.moments(contour)
         if moments['m00'] == 0:
             continue
         # if contour area for a given class is very small then omit that
-        if cv2.contourArea(contours[i]) < 2000:
+        area_indi = cv2.contourArea(contour)
+        if area_indi < 2000:
             continue
-        totArea = totArea + cv2.contourArea(contours[i])
-        area.append(cv2.contourArea(contours[i]))
-        centres.append(
-            (int(moments['m10'] / moments['m00']),
-             int(moments['m01'] / moments['m00'])))
-        area_indi = cv2.contourArea(contours[i])
         centre_indi = (int(moments['m10'] / moments['m00']),
                        int(moments['m01'] / moments['m00']))
-        contour_indi = [list(x) for x in contours[i]]
-        contour_indi = np.squeeze(contour_indi)
-        centre_down = [centre_indi[0] / width, centre_indi[1] / height]
-        area_down = area_indi / (width * height)
-        contour_indi = contour_indi.tolist()
-        for j in range(len(contour_indi)):
-            contour_indi[j][0] = float(float(contour_indi[j][0]) / width)
-            contour_indi[j][1] = float(float(contour_indi[j][1]) / height)
-        send_contour.append({"coordinates": contour_indi,
-                            "centroid": centre_down, "area": area_down})
+        area.append(area_indi)
+        centres.append(centre_indi)
+        found.append({
+            "contour": contour,
+            "centroid": [centre_indi[0] / width, centre_indi[1] / height],
+            "area": area_indi / (width * height)})
     if not area:
-        flag = True
-    else:
-        max_value = max(area)
-    if flag is True:
         return ([0, 0], [0, 0], 0)
-    centre1 = centres[area.index(max_value)][0] / width
-    centre2 = centres[area.index(max_value)][1] / height
-    centre = [centre1, centre2]
-    totArea = totArea / (width * height)
-    result = np.concatenate(contours, dtype=np.float32)
+    largest = centres[area.index(max(area))]
+    centre = [largest[0] / width, largest[1] / height]
+    totArea = sum(area) / (width * height)
     # if contour is very small then delete it
     if totArea < 0.05:
         return ([0, 0], [0, 0], 0)
-    result = np.squeeze(result)
-    result = np.swapaxes(result, 0, 1)
-    result[0] = result[0] / float(width)
-    result[1] = result[1] / float(height)
-#    send = np.swapaxes(result, 0, 1).tolist()
-    return send_contour, centre, totArea
+    return found, centre, totArea
+
+
+# simplifies the contours found by findContour and normalises their
+# points; tolerance is a fraction of the image diagonal
+def simplifyContours(found, width, height, tolerance=0.0):
+    scale = np.array([width, height], dtype=np.float64)
+    epsilon = tolerance * np.hypot(width, height)
+    # centroid and area come from the full contour
+    return [{"coordinates": (simplify(f["contour"], epsilon).reshape(-1, 2)
+                             / scale).tolist(),
+             "centroid": f["centroid"],
+             "area": f["area"]} for f in found]
 
 
 def run_segmentation(url,
                      segmentation_module,
                      dictionary,
-                     pil_to_tensor):
+                     pil_to_tensor,
+                     max_side=SEG_MAX_SIDE,
+                     timings=None):
+    clock = StageTimer(timings)
     # convert an image from base64 format
     # Following 4 lines refered from
     # https://gist.github.com/daino3/b671b2d171b3948692887e4c484caf47
@@ -139,53 +259,76 @@ def run_segmentation(url,
     binary = base64.b64decode(image_b64)
     image = np.asarray(bytearray(binary), dtype="uint8")
     pil_image = cv2.imdecode(image, cv2.IMREAD_COLOR)
+    clock.lap('decode')
     height, width, channels = pil_image.shape
-    scale_size = np.float(1500.0 / np.float(max(height, width)))
-    # scale down an image to avoid OOM error
+    scale_size = float(max_side) / float(max(height, width))
+    # scale down an image to bound memory use and latency
     if scale_size <= 1.0:
-        height = np.int(height * scale_size)
-        width = np.int(width * scale_size)
+        height = int(height * scale_size)
+        width = int(width * scale_size)
         pil_image = cv2.resize(pil_image, (width, height),
                                interpolation=cv2.INTER_AREA)
     img = pil_image
     height, width, channels = img.shape
-    img_original = numpy.array(img)
+    clock.lap('resize')
     img_data = pil_to_tensor(img)
     try:
-        img_data = img_data.cuda()
+        img_data = img_data[None].to(device, memory_format=memory_format)
     except RuntimeError as e:
         if 'out of memory' in str(e):
             print("OOM detected")
             torch.cuda.empty_cache()
             return jsonify("OOM detected"), 500
-    singleton_batch = {'img_data': img_data[None]}
-    output_size = img_data.shape[1:]
-    with torch.no_grad():
+    singleton_batch = {'img_data': img_data}
+    output_size = img_data.shape[2:]
+    clock.lap('to_tensor')
+    with torch.no_grad(), autocast():
         # get segmentation results
         scores = segmentation_module(singleton_batch,
                                      segSize=output_size)
-    _, pred = torch.max(scores, dim=1)
-    pred = pred.cpu()[0].numpy()
-    color, name = visualize_result(img_original, pred, 0)
-    predicted_classes = numpy.bincount(pred.flatten()).argsort()[::-1]
+    clock.lap('inference')
+    # the label map stays on the device; only the masks of the top
+    # classes are transferred
+    pred = scores[0].argmax(dim=0)
+    predicted_classes = rank_classes(pred)
+    masks = class_masks(pred, predicted_classes)
+    predicted_classes = predicted_classes.tolist()
+    clock.lap('argmax')
     logging.info("Segments detected, Runnning contour code")
-    for c in predicted_classes[:5]:
-        color, name = visualize_result(img_original, pred, c)
-        # find contours for every class
-        send, center, area = findContour(color, width, height)
+    # find contours for every class once; only their simplification is
+    # repeated to fit the response budget
+    found = []
+    for c, mask in zip(predicted_classes, masks):
+        contours, center, area = findContour(mask, width, height)
         if area == 0:
             continue
-        dictionary.append(
-            {"name": name, "contours": send,
-             "centroid": center, "area": area})
+        found.append((c, contours, center, area))
+    tolerance = SEG_SIMPLIFY_TOLERANCE
+    while True:
+        segments = [
+            {"name": names[c + 1],
+             "contours": simplifyContours(contours, width, height,
+                                          tolerance),
+             "centroid": center, "area": area}
+            for c, contours, center, area in found]
+        points = sum(len(contour["coordinates"])
+                     for segment in segments
+                     for contour in segment["contours"])
+        if SEG_MAX_TOTAL_POINTS <= 0 or points <= SEG_MAX_TOTAL_POINTS \
+                or tolerance >= 0.05:
+            break
+        # too large for the response budget, simplify more coarsely
+        tolerance = tolerance * 2 if tolerance > 0 else 0.001
+    logging.debug("{} contour points at tolerance {}".format(
+        points, tolerance))
+    dictionary.extend(segments)
+    clock.lap('contours')
     return {"segments": dictionary}
 
 
 @app.route("/preprocessor", methods=['POST', 'GET'])
 def segment():
     logging.debug("Received request")
-    gc.collect()
-    torch.cuda.empty_cache()
     dictionary = []
     # load all the schemas
     with open('./schemas/preprocessors/segmentation.schema.json') as jsonfile:
@@ -205,33 +348,6 @@ def segment():
     resolver = jsonschema.RefResolver.from_schema(
         schema, store=schema_store)
     logging.info("Schemas loaded")
-    # load all the models
-    net_encoder = ModelBuilder.build_encoder(
-        arch='resnet50dilated',
-        fc_dim=2048,
-        weights='encoder_epoch_20.pth')
-    net_decoder = ModelBuilder.build_decoder(
-        arch='ppm_deepsup',
-        fc_dim=2048,
-        num_class=150,
-        weights='decoder_epoch_20.pth',
-        use_softmax=True)
-    crit = torch.nn.NLLLoss(ignore_index=-1)
-    segmentation_module = SegmentationModule(net_encoder, net_decoder, crit)
-    segmentation_module.eval()
-    try:
-        segmentation_module.cuda()
-    except RuntimeError as e:
-        if 'out of memory' in str(e):
-            print("OOM detected")
-            torch.cuda.empty_cache()
-            return jsonify("OOM detected"), 500
-    pil_to_tensor = torchvision.transforms.Compose([
-        torchvision.transforms.ToTensor(),
-        torchvision.transforms.Normalize(
-            mean=[0.485, 0.456, 0.406],
-            std=[0.229, 0.224, 0.225])
-    ])
     content = request.get_json()
     # check if the input json is a valid json
     try:
@@ -288,7 +404,6 @@ def segment():
                                    segmentation_module,
                                    dictionary,
                                    pil_to_tensor)
-    torch.cuda.empty_cache()
     try:
         validator = jsonschema.Draft7Validator(data_schema)
         validator.validate(segment)
@@ -312,5 +427,56 @@ def segment():
     return response
 
 
+@app.route("/health", methods=['GET'])
+def health():
+    """
+    Reports whether the segmentation model has been loaded and warmed up
+    """
+    if model_ready:
+        return jsonify("ready"), 200
+    return jsonify("loading"), 503
+
+
+def benchmark(image_dir, max_sides, runs=3):
+    """
+    Prints the mean time spent in each stage for every max side, to
+    choose the resolution/latency trade-off on this machine
+    """
+    images = []
+    for file in sorted(os.listdir(image_dir)):
+        if file.lower().endswith(('.png', '.jpg', '.jpeg')):
+            with open(os.path.join(image_dir, file), 'rb') as f:
+                images.append("data:image;base64," +
+                              base64.b64encode(f.read()).decode())
+    print("{} images on {} ({} threads, bf16 {})".format(
+        len(images), device, torch.get_num_threads(), SEG_BF16))
+    stages = ['decode', 'resize', 'to_tensor', 'inference', 'argmax',
+              'contours']
+    print("{:>8}".format('max side') +
+          "".join("{:>11}".format(s) for s in stages) +
+          "{:>11}".format('total'))
+    for max_side in max_sides:
+        timings = {}
+        for _ in range(runs):
+            for url in images:
+                run_segmentation(url, segmentation_module, [],
+                                 pil_to_tensor, max_side, timings)
+        count = runs * len(images)
+        means = [timings.get(s, 0.0) / count for s in stages]
+        print("{:>8}".format(max_side) +
+              "".join("{:>11.1f}".format(m) for m in means) +
+              "{:>11.1f}".format(sum(means)))
+
+
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmark', metavar='IMAGE_DIR',
+                        help="report per-stage timings instead of serving")
+    parser.add_argument('--max-sides', type=int, nargs='+',
+                        default=[500, 1000, 1500])
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark(args.benchmark, args.max_sides, args.runs)
+    else:
+        app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,80 @@
+# Copyright (c) 2021 IMAGE Project, Shared Reality Lab, McGill University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# and our Additional Terms along with this program.
+# If not, see
+# <https://github.com/Shared-Reality-Lab/IMAGE-server/blob/main/LICENSE>.
+#
+# Shrinks graphics before they are uploaded to a cloud vision API. This
+# file is copied into each preprocessor image that calls such an API.
+
+import io
+import logging
+import os
+
+from PIL import Image, ImageOps
+
+# Graphics smaller than UPLOAD_MIN_BYTES that fit the requested size are
+# sent untouched. Others are scaled down and re-encoded: as JPEG
+# (quality UPLOAD_JPEG_QUALITY) if they have many colours, like photos,
+# or as PNG if they have few, like text and charts.
+UPLOAD_MIN_BYTES = int(os.environ.get('UPLOAD_MIN_BYTES', 200000))
+UPLOAD_JPEG_QUALITY = int(os.environ.get('UPLOAD_JPEG_QUALITY', 90))
+PALETTE_COLOURS = 256
+EXIF_ORIENTATION = 0x0112
+
+
+def prepare_upload(binary, max_side):
+    """
+    Returns the bytes to upload, their MIME type and the factor the
+    graphic was scaled by; pixel coordinates returned by the API are
+    divided by this factor to get back to the original graphic
+    """
+    try:
+        image = Image.open(io.BytesIO(binary))
+        mime = Image.MIME.get(image.format, 'application/octet-stream')
+        # re-encoding drops the EXIF data, so rotate camera photos
+        # upright first, as they are displayed
+        if image.getexif().get(EXIF_ORIENTATION, 1) != 1:
+            image = ImageOps.exif_transpose(image)
+        width, height = image.size
+        scale = min(1.0, max_side / max(width, height))
+        if scale == 1.0 and len(binary) <= UPLOAD_MIN_BYTES:
+            return binary, mime, 1.0
+        if scale < 1.0:
+            size = (max(1, round(width * scale)),
+                    max(1, round(height * scale)))
+            image = image.resize(size, Image.LANCZOS)
+            # use the factor the pixels were actually scaled by
+            scale = size[0] / width
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        out = io.BytesIO()
+        if image.getcolors(PALETTE_COLOURS) is not None:
+            image.save(out, format='PNG', optimize=True)
+            encoded = 'image/png'
+        else:
+            if image.mode == 'RGBA':
+                # flatten transparent areas onto white rather than black
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            image.save(out, format='JPEG', quality=UPLOAD_JPEG_QUALITY)
+            encoded = 'image/jpeg'
+    except (OSError, ValueError) as e:
+        logging.warning("Could not re-encode the graphic: {}".format(e))
+        return binary, 'application/octet-stream', 1.0
+    data = out.getvalue()
+    if scale == 1.0 and len(data) >= len(binary):
+        return binary, mime, 1.0
+    logging.debug("Upload reduced from {} to {} bytes (scale {:.3f})".format(
+        len(binary), len(data), scale))
+    return data, encoded, scale
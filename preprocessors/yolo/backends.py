@@ -0,0 +1,236 @@
+# Copyright (c) 2021 IMAGE Project, Shared Reality Lab, McGill University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# and our Additional Terms along with this program.
+# If not, see
+# <https://github.com/Shared-Reality-Lab/IMAGE-server/blob/main/LICENSE>.
+#
+# Inference backends for the YOLOv5 detector. The eager PyTorch model is
+# the default; the same weights can be exported once to TorchScript or
+# ONNX (optionally with int8 dynamic quantization) and run from there.
+# Export with e.g.
+#     python backends.py --weights yolov5x.pt --backend onnx --int8
+
+import argparse
+import json
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+import torch
+
+from models.experimental import attempt_load
+from models.yolo import Detect
+
+BACKENDS = ('eager', 'torchscript', 'onnx')
+
+# Where a missing export is written at startup; the image exports next to
+# the weights at build time, and the service cannot write there
+EXPORT_DIR = os.environ.get(
+    'YOLO_EXPORT_DIR', os.path.join(tempfile.gettempdir(), 'yolo'))
+
+
+def export_path(weights, backend, int8=False, directory=None):
+    """
+    Returns where the exported model for the given weights is kept,
+    next to them unless another directory is given
+    """
+    stem = Path(weights).with_suffix('')
+    if directory is not None:
+        stem = Path(directory) / stem.name
+    stem = str(stem)
+    if backend == 'torchscript':
+        return stem + '.torchscript.pt'
+    if backend == 'onnx':
+        return stem + ('.int8.onnx' if int8 else '.onnx')
+    raise ValueError("Unknown backend {}".format(backend))
+
+
+def export(weights, backend, imgsz=640, int8=False, directory=None):
+    """
+    Exports the eager model to TorchScript or ONNX and returns the path
+    """
+    model = attempt_load(weights, map_location=torch.device('cpu'))
+    model.eval()
+    stride = int(model.stride.max())
+    names = model.module.names if hasattr(model, 'module') else model.names
+    for m in model.modules():
+        if isinstance(m, Detect):
+            m.inplace = False
+            # recompute the grid for every input shape so the ONNX graph
+            # accepts any batch and letterbox size
+            m.onnx_dynamic = backend == 'onnx'
+    img = torch.zeros(1, 3, imgsz, imgsz)
+    model(img)  # dry run
+    config = {'stride': stride, 'names': list(names), 'imgsz': imgsz}
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+    path = export_path(weights, backend, int8, directory)
+
+    if backend == 'torchscript':
+        if int8:
+            logging.warning("int8 is only supported by the onnx backend")
+        traced = torch.jit.trace(model, img, strict=False)
+        traced.save(path, _extra_files={'config.txt': json.dumps(config)})
+
+    elif backend == 'onnx':
+        import onnx
+        fp32_path = export_path(weights, backend, directory=directory)
+        torch.onnx.export(
+            model, img, fp32_path, opset_version=12,
+            do_constant_folding=True,
+            input_names=['images'], output_names=['output'],
+            dynamic_axes={'images': {0: 'batch', 2: 'height', 3: 'width'},
+                          'output': {0: 'batch', 1: 'anchors'}})
+        model_onnx = onnx.load(fp32_path)
+        onnx.checker.check_model(model_onnx)
+        for key, value in config.items():
+            meta = model_onnx.metadata_props.add()
+            meta.key, meta.value = key, json.dumps(value)
+        onnx.save(model_onnx, fp32_path)
+        if int8:
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            quantize_dynamic(fp32_path, path, weight_type=QuantType.QUInt8)
+
+    else:
+        raise ValueError("Cannot export to {}".format(backend))
+    logging.info("Exported {} to {}".format(weights, path))
+    return path
+
+
+class EagerBackend:
+    """
+    The model returned by attempt_load, run directly in PyTorch
+    """
+    dynamic = True
+
+    def __init__(self, weights, device, half=False):
+        self.device = device
+        self.model = attempt_load(weights, map_location=device)
+        if half:
+            self.model.half()
+        self.model.eval()
+        self.stride = int(self.model.stride.max())
+        self.names = self.model.module.names \
+            if hasattr(self.model, 'module') else self.model.names
+        self.imgsz = None
+
+    @torch.no_grad()
+    def __call__(self, img, augment=False):
+        return self.model(img, augment=augment)[0]
+
+    def after_fork(self, threads):
+        pass
+
+
+class TorchScriptBackend:
+    """
+    A traced model; it only accepts the square input size it was
+    exported with
+    """
+    dynamic = False
+
+    def __init__(self, path, device):
+        self.device = device
+        extra_files = {'config.txt': ''}
+        self.model = torch.jit.load(
+            path, map_location=device, _extra_files=extra_files)
+        self.model.eval()
+        config = json.loads(extra_files['config.txt'])
+        self.stride = config['stride']
+        self.names = config['names']
+        self.imgsz = config['imgsz']
+
+    @torch.no_grad()
+    def __call__(self, img, augment=False):
+        return self.model(img)[0]
+
+    def after_fork(self, threads):
+        pass
+
+
+class OnnxBackend:
+    """
+    An exported ONNX graph run on CPU by ONNX Runtime
+    """
+    dynamic = True
+
+    def __init__(self, path, threads=0):
+        self.path = path
+        self.device = torch.device('cpu')
+        self.session = self._open(threads)
+        meta = self.session.get_modelmeta().custom_metadata_map
+        self.stride = json.loads(meta['stride'])
+        self.names = json.loads(meta['names'])
+        self.imgsz = None
+        self.input_name = self.session.get_inputs()[0].name
+
+    def _open(self, threads):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = \
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        return onnxruntime.InferenceSession(
+            self.path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, img, augment=False):
+        pred = self.session.run(
+            None, {self.input_name: img.cpu().numpy()})[0]
+        return torch.from_numpy(pred)
+
+    def after_fork(self, threads):
+        # the session's thread pool does not survive a fork, so each
+        # worker opens its own session
+        self.session = self._open(threads)
+
+
+def load_backend(backend, weights, device, half=False, imgsz=640,
+                 threads=0, int8=False):
+    """
+    Creates the requested backend, exporting the weights to EXPORT_DIR
+    first if there is no exported model next to them or there
+    """
+    if backend not in BACKENDS:
+        raise ValueError("Unknown backend {}".format(backend))
+    if threads > 0 and backend != 'onnx':
+        torch.set_num_threads(threads)
+    if backend == 'eager':
+        return EagerBackend(weights, device, half)
+    path = export_path(weights, backend, int8)
+    if not Path(path).exists():
+        path = export_path(weights, backend, int8, EXPORT_DIR)
+    if not Path(path).exists():
+        logging.warning("No exported model at {}, exporting".format(path))
+        export(weights, backend, imgsz, int8, EXPORT_DIR)
+    if backend == 'torchscript':
+        return TorchScriptBackend(path, device)
+    return OnnxBackend(path, threads)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export the YOLOv5 weights for a faster CPU backend")
+    parser.add_argument('--weights', default='yolov5x.pt')
+    parser.add_argument('--backend', choices=BACKENDS[1:], default='onnx')
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--int8', action='store_true',
+                        help="also write a dynamically quantized model")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(export(args.weights, args.backend, args.imgsz, args.int8))
+
+
+if __name__ == "__main__":
+    main()
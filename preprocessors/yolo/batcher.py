@@ -0,0 +1,159 @@
+# Copyright (c) 2021 IMAGE Project, Shared Reality Lab, McGill University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# and our Additional Terms along with this program.
+# If not, see
+# <https://github.com/Shared-Reality-Lab/IMAGE-server/blob/main/LICENSE>.
+
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from datasetsChanged import LoadArray
+from utils.general import non_max_suppression, scale_coords
+
+# Requests are collected for at most BATCH_WAIT_MS milliseconds or until
+# MAX_BATCH_SIZE images are waiting, whichever comes first. Images
+# submitted together with submit_many are never split across batches.
+MAX_BATCH_SIZE = int(os.environ.get('YOLO_MAX_BATCH_SIZE', 8))
+BATCH_WAIT_MS = float(os.environ.get('YOLO_BATCH_WAIT_MS', 10))
+
+_schedulers = {}
+_lock = threading.Lock()
+
+
+class _Request:
+    def __init__(self, im0, key):
+        self.im0 = im0
+        self.key = key
+        self.future = Future()
+
+
+class BatchScheduler:
+    """
+    Groups images submitted concurrently by different requests into a
+    single batched forward pass and hands each request its own detections
+    """
+    def __init__(self, detector, max_batch_size=MAX_BATCH_SIZE,
+                 max_wait_ms=BATCH_WAIT_MS):
+        self.detector = detector
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, im0, imgsz=None, conf_thres=0.25, iou_thres=0.45,
+               classes=None, agnostic_nms=False, augment=False):
+        """
+        Queues a decoded BGR image and returns a future resolving to its
+        detections (xyxy, conf, cls) in original image coordinates
+        """
+        return self.submit_many([im0], imgsz, conf_thres, iou_thres,
+                                classes, agnostic_nms, augment)[0]
+
+    def submit_many(self, images, imgsz=None, conf_thres=0.25,
+                    iou_thres=0.45, classes=None, agnostic_nms=False,
+                    augment=False):
+        """
+        Queues several images to run in the same forward pass, even if
+        there are more than max_batch_size, and returns a future per image
+        """
+        self._ensure_worker()
+        if classes is not None:
+            classes = tuple(classes)
+        imgsz = imgsz or self.detector.imgsz
+        key = (imgsz, conf_thres, iou_thres, classes, agnostic_nms, augment)
+        reqs = [_Request(im0, key) for im0 in images]
+        self._queue.put(reqs)
+        return [req.future for req in reqs]
+
+    def detect(self, im0, **kwargs):
+        return self.submit(im0, **kwargs).result()
+
+    def _ensure_worker(self):
+        # the worker is started lazily so that it is created in the
+        # process that actually serves requests
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._loop, name='yolo-batcher', daemon=True)
+                self._thread.start()
+
+    def _collect(self):
+        batch = list(self._queue.get())
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.extend(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            # requests can only share a forward pass and NMS call if
+            # they use the same settings
+            groups = {}
+            for req in batch:
+                groups.setdefault(req.key, []).append(req)
+            for key, reqs in groups.items():
+                try:
+                    dets = self._run(reqs, *key)
+                except Exception as e:
+                    logging.error(e)
+                    for req in reqs:
+                        req.future.set_exception(e)
+                    continue
+                for req, det in zip(reqs, dets):
+                    req.future.set_result(det)
+
+    def _run(self, reqs, imgsz, conf_thres, iou_thres, classes,
+             agnostic_nms, augment):
+        detector = self.detector
+        # a lone image keeps the minimal rectangle letterbox, a batch (or
+        # a backend with a fixed input shape) uses the square input size
+        auto = len(reqs) == 1 and detector.backend.dynamic
+        imgs = [LoadArray(req.im0, imgsz,
+                          stride=detector.stride, auto=auto).load()[0]
+                for req in reqs]
+        img = detector.prepare(np.stack(imgs))
+        logging.debug("Running batch of {} at {}x{}".format(
+            len(reqs), img.shape[2], img.shape[3]))
+        pred = detector(img, augment=augment)
+        pred = non_max_suppression(
+            pred, conf_thres, iou_thres,
+            list(classes) if classes is not None else None, agnostic_nms)
+        for req, det in zip(reqs, pred):
+            if len(det):
+                det[:, :4] = scale_coords(
+                    img.shape[2:], det[:, :4], req.im0.shape).round()
+        return pred
+
+
+def get_scheduler(detector):
+    """
+    Returns the batch scheduler in front of the given detector
+    """
+    with _lock:
+        if id(detector) not in _schedulers:
+            _schedulers[id(detector)] = BatchScheduler(detector)
+    return _schedulers[id(detector)]
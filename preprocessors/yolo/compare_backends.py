@@ -0,0 +1,152 @@
+# Copyright (c) 2021 IMAGE Project, Shared Reality Lab, McGill University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# and our Additional Terms along with this program.
+# If not, see
+# <https://github.com/Shared-Reality-Lab/IMAGE-server/blob/main/LICENSE>.
+#
+# Runs the eager model and the exported backends on the same images and
+# reports how far each backend's detections drift from the eager ones
+# (mAP using the eager detections as ground truth) along with p50/p95
+# latency, e.g.
+#     python compare_backends.py --images samples/ \
+#         --backends torchscript onnx onnx-int8 --threads 4
+
+import argparse
+import json
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+import torch
+
+from datasetsChanged import LoadArray, img_formats
+from model_registry import Detector
+from utils.general import non_max_suppression, scale_coords
+from utils.metrics import ap_per_class
+from val import process_batch
+
+
+def load_images(path):
+    files = sorted(p for p in Path(path).iterdir()
+                   if p.suffix[1:].lower() in img_formats)
+    images = [cv2.imread(str(p)) for p in files]
+    return [im for im in images if im is not None]
+
+
+def run_backend(detector, images, conf_thres, iou_thres, warmup):
+    """
+    Returns the detections for every image and the latency of each
+    forward pass plus NMS in milliseconds
+    """
+    for im0 in images[:warmup]:
+        detector(detector.prepare(LoadArray(
+            im0, detector.imgsz, detector.stride,
+            auto=detector.backend.dynamic).load()[0]))
+    preds, latencies = [], []
+    for im0 in images:
+        img = detector.prepare(LoadArray(
+            im0, detector.imgsz, detector.stride,
+            auto=detector.backend.dynamic).load()[0])
+        start = time.perf_counter()
+        pred = detector(img)
+        det = non_max_suppression(pred, conf_thres, iou_thres)[0]
+        latencies.append((time.perf_counter() - start) * 1000)
+        det[:, :4] = scale_coords(img.shape[2:], det[:, :4], im0.shape)
+        preds.append(det.cpu().float())
+    return preds, latencies
+
+
+def map_against(reference, candidate):
+    """
+    mAP@0.5 and mAP@0.5:0.95 of the candidate detections, using the
+    reference detections as ground truth
+    """
+    iouv = torch.linspace(0.5, 0.95, 10)
+    stats = []
+    for ref, det in zip(reference, candidate):
+        labels = ref[:, [5, 0, 1, 2, 3]]
+        if len(det) == 0:
+            if len(labels):
+                stats.append((torch.zeros(0, len(iouv), dtype=torch.bool),
+                              torch.Tensor(), torch.Tensor(), labels[:, 0]))
+            continue
+        if len(labels):
+            correct = process_batch(det, labels, iouv)
+        else:
+            correct = torch.zeros(len(det), len(iouv), dtype=torch.bool)
+        stats.append((correct, det[:, 4], det[:, 5], labels[:, 0]))
+    if not stats:
+        return 1.0, 1.0
+    stats = [np.concatenate([s.numpy() for s in x], 0) for x in zip(*stats)]
+    if not stats[0].any():
+        return 0.0, 0.0
+    p, r, ap, f1, ap_class = ap_per_class(*stats)
+    return float(ap[:, 0].mean()), float(ap.mean(1).mean())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare exported YOLOv5 backends against eager")
+    parser.add_argument('--images', required=True,
+                        help="directory of sample images")
+    parser.add_argument('--weights', default='yolov5x.pt')
+    parser.add_argument('--backends', nargs='+',
+                        default=['torchscript', 'onnx', 'onnx-int8'],
+                        help="torchscript, onnx and/or onnx-int8")
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--conf-thres', type=float, default=0.25)
+    parser.add_argument('--iou-thres', type=float, default=0.45)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--json', help="also write the report here")
+    args = parser.parse_args()
+
+    images = load_images(args.images)
+    if not images:
+        raise SystemExit("No images found in {}".format(args.images))
+
+    report = {}
+    reference = None
+    for spec in ['eager'] + args.backends:
+        backend, _, variant = spec.partition('-')
+        detector = Detector(args.weights, 'cpu', args.imgsz,
+                            backend=backend, threads=args.threads,
+                            int8=variant == 'int8')
+        preds, latencies = run_backend(detector, images, args.conf_thres,
+                                       args.iou_thres, args.warmup)
+        if reference is None:
+            reference = preds
+        map50, map5095 = map_against(reference, preds)
+        report[spec] = {
+            'mAP@0.5': map50,
+            'mAP@0.5:0.95': map5095,
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p95_ms': float(np.percentile(latencies, 95)),
+        }
+
+    print("{} images, {}px, {} threads".format(
+        len(images), args.imgsz, args.threads or torch.get_num_threads()))
+    print("{:<14}{:>10}{:>14}{:>10}{:>10}".format(
+        'backend', 'mAP@0.5', 'mAP@0.5:0.95', 'p50 ms', 'p95 ms'))
+    for spec, row in report.items():
+        print("{:<14}{:>10.4f}{:>14.4f}{:>10.1f}{:>10.1f}".format(
+            spec, row['mAP@0.5'], row['mAP@0.5:0.95'],
+            row['p50_ms'], row['p95_ms']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
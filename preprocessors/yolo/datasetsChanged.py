@@ -216,6 +216,42 @@ class LoadImages:  # for inference
         return self.nf  # number of files
 
 
+class LoadArray:  # for inference on an already decoded image
+    # Same output as LoadImages, but takes the BGR ndarray decoded by the
+    # caller so the graphic is not decoded a second time
+    def __init__(self, img0, img_size=640, stride=32, auto=True):
+        assert img0 is not None, 'Image Not Found'
+        self.img0 = img0
+        self.img_size = img_size
+        self.stride = stride
+        self.auto = auto
+        self.nf = 1
+        self.mode = 'image'
+
+    def load(self):
+        # Padded resize
+        img = letterbox(self.img0, self.img_size, stride=self.stride, auto=self.auto)[0]
+
+        # Convert
+        img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB and HWC to CHW
+        img = np.ascontiguousarray(img)
+        return img, self.img0.shape
+
+    def __iter__(self):
+        self.count = 0
+        return self
+
+    def __next__(self):
+        if self.count == self.nf:
+            raise StopIteration
+        self.count += 1
+        img, _ = self.load()
+        return None, img, self.img0, None
+
+    def __len__(self):
+        return self.nf
+
+
 class LoadWebcam:  # for inference
     def __init__(self, pipe='0', img_size=640, stride=32):
         self.img_size = img_size
@@ -17,7 +17,6 @@
 
 
 import time
-from pathlib import Path
 from flask import Flask, jsonify, request
 import cv2
 import torch
@@ -28,23 +27,57 @@ import json
 import logging
 import os
 
-from models.experimental import attempt_load
-from datasetsChanged import LoadImages
-from utils.general import check_img_size, non_max_suppression, \
-    apply_classifier, scale_coords, set_logging
-from utils.torch_utils import select_device, load_classifier
+from utils.general import set_logging
+import batcher
+import model_registry
+import resolution
+import tiling
 
 
 os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'
 app = Flask(__name__)
 
+# the detector is loaded and warmed up once when the worker starts and
+# then reused by every request instead of being reloaded per request
+WEIGHTS = 'yolov5x.pt'
+IMGSZ = 640
+set_logging()
+resolution.get_policy(model_registry.get_detector(WEIGHTS, imgsz=IMGSZ))
+
+
+def detections_to_objects(det, names, width, height):
+    """
+    Converts the (xyxy, conf, cls) detections of one image into the
+    object dicts of the schema, measuring every box in one pass
+    """
+    # same order as iterating over reversed(det)
+    det = det.flip(0).cpu().numpy()
+    # boxes are whole pixels after scale_coords, normalise them
+    scale = np.array([width, height, width, height], dtype=np.float64)
+    boxes = det[:, :4].astype(np.int64) / scale
+    centroids = np.abs((boxes[:, :2] + boxes[:, 2:]) / 2)
+    areas = np.abs(boxes[:, 2] - boxes[:, 0]) * \
+        np.abs(boxes[:, 3] - boxes[:, 1])
+    confidences = np.round(det[:, 4].astype(np.float64), 2)
+    # the type keeps the trailing space of the former "name 0.00" label
+    # slicing since handlers strip it
+    types = [names[c] + ' ' for c in det[:, 5].astype(np.int64)]
+    return [{
+        "ID": i,
+        "type": label,
+        "dimensions": box,
+        "confidence": conf,
+        "centroid": centre,
+        "area": area
+    } for i, (label, box, conf, centre, area) in enumerate(zip(
+        types, boxes.tolist(), confidences.tolist(),
+        centroids.tolist(), areas.tolist()))]
+
 
 def detect_objects(send,
-                   device,
-                   weights,
+                   detector,
+                   image,
                    imgsz,
-                   half,
-                   source,
                    augment,
                    width,
                    height,
@@ -54,95 +87,43 @@ def detect_objects(send,
                    agnostic_nms,
                    save_img,
                    save_crop,
-                   view_img,
-                   hide_labels,
-                   hide_conf):
-    model = attempt_load(weights, map_location=device)
-    stride = int(model.stride.max())
-    imgsz = check_img_size(imgsz, s=stride)
-    names = model.module.names if hasattr(model, 'module') else model.names
-    if half:
-        model.half()
-    classify = False
-    if classify:
-        modelc = load_classifier(name='resnet50', n=2)
-        modelc.load_state_dict(
-            torch.load(
-                'resnet50.pt',
-                map_location=device
-            )['model']
-        ).to(device).eval()
-    # load images by converting them from base64 to readable format
-    dataset = LoadImages(source, img_size=imgsz, stride=stride)
-    # generate the predictions
-    if device.type != 'cpu':
-        model(torch.zeros(1, 3, imgsz, imgsz).to(
-            device).type_as(next(model.parameters())))
-    for path, img, im0s, vid_cap in dataset:
-        img = torch.from_numpy(img).to(device)
-        img = img.half() if half else img.float()
-        img /= 255.0
-        if img.ndimension() == 3:
-            img = img.unsqueeze(0)
-        # get predictions for the model
-        pred = model(img, augment=augment)[0]
-        # , max_det=max_det)
-        pred = non_max_suppression(
-            pred, conf_thres, iou_thres, classes, agnostic_nms)
-        if classify:
-            pred = apply_classifier(pred, modelc, img, im0s)
-        # once the predictions are generated convert
-        # the image to original size.
-        for i, det in enumerate(pred):
-            p, s, im0 = path, '', im0s.copy()
-            p = Path(p)
-            s += '%gx%g ' % img.shape[2:]
-            if len(det):
-                det[:, :4] = scale_coords(
-                    img.shape[2:], det[:, :4], im0.shape).round()
-                for c in det[:, -1].unique():
-                    n = (det[:, -1] == c).sum()
-                    s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "
-                i = 0
-                # create a json output and validate the json
-                for *xyxy, conf, cls in reversed(det):
-                    if save_img or save_crop or view_img:
-                        c = int(cls)
-                        label = None if hide_labels else (
-                            names[c] if hide_conf else
-                            f'{names[c]} {conf:.2f}'
-                        )
-                        # normalise the image
-                        xleft = int(xyxy[0]) / width
-                        yleft = int(xyxy[1]) / height
-                        xright = int(xyxy[2]) / width
-                        yright = int(xyxy[3]) / height
-                        centre = [abs((xleft + xright) / 2),
-                                  abs((yleft + yright) / 2)]
-                        area = abs(xleft - xright) * abs(yleft - yright)
-                        dictionary = {
-                            "ID": i,
-                            "type": str(label[:-4]),
-                            "dimensions": [xleft, yleft, xright, yright],
-                            "confidence": np.float64(label[-4:]),
-                            "centroid": centre, "area": area
-                        }
-                        send.append(dictionary)
-                        """"plot_one_box(xyxy, im0, label=label,
-                        color=colors(c, True),
-                        line_thickness=line_thickness) # noqa"""
-                        i = i + 1
-            things = {"objects": send}
-            return things
+                   view_img):
+    names = detector.names
+    scheduler = batcher.get_scheduler(detector)
+    # generate the predictions for the image already decoded in run();
+    # concurrent requests share one batched forward pass and come back
+    # scaled to the original image
+    if tiling.use_tiling(width, height):
+        # very large photographs are run as overlapping tiles
+        imgsz = tiling.tile_imgsz(detector)
+        det = tiling.detect_tiled(scheduler, image, imgsz,
+                                  conf_thres=conf_thres,
+                                  iou_thres=iou_thres,
+                                  classes=classes,
+                                  agnostic_nms=agnostic_nms,
+                                  augment=augment)
+    else:
+        det = scheduler.detect(image,
+                               imgsz=imgsz,
+                               conf_thres=conf_thres,
+                               iou_thres=iou_thres,
+                               classes=classes,
+                               agnostic_nms=agnostic_nms,
+                               augment=augment)
+    if len(det) and (save_img or save_crop or view_img):
+        send.extend(detections_to_objects(det, names, width, height))
+    logging.debug("Detected {} objects at {}px".format(len(send), imgsz))
+    things = {"objects": send}
+    return things
 
 
 @torch.no_grad()
 @app.route("/preprocessor", methods=['POST', 'GET'])
 # The parameters in run function were generated by the author of the code.
 # Do not interfere with this as this breaks the code in some other file
-def run(weights='yolov5x.pt',
+def run(weights=WEIGHTS,
         source='data/images',
-        imgsz=640,
+        imgsz=IMGSZ,
         conf_thres=0.25,
         iou_thres=0.45,
         max_det=1000,
@@ -162,10 +143,8 @@ def run(weights='yolov5x.pt',
         ):
     logging.debug("Received request")
     save_img = not nosave and not source.endswith('.txt')
-    set_logging()
-    device = select_device(device)
+    detector = model_registry.get_detector(weights, device, imgsz, half)
     send = []
-    half &= device.type != 'cpu'
 
     # Accept the input and load the schemas
     if request.method == 'POST':
@@ -207,9 +186,13 @@ def run(weights='yolov5x.pt',
         source = content["graphic"]
         image_b64 = source.split(",")[1]
         binary = base64.b64decode(image_b64)
-        image = np.asarray(bytearray(binary), dtype="uint8")
-        imgDim = cv2.imdecode(image, cv2.IMREAD_COLOR)
-        height, width, channels = imgDim.shape
+        # the graphic is decoded once here and the same array is
+        # letterboxed for inference
+        image = cv2.imdecode(
+            np.frombuffer(binary, dtype="uint8"), cv2.IMREAD_COLOR)
+        height, width, channels = image.shape
+        # small graphics are not upscaled into a full size forward pass
+        size = resolution.get_policy(detector).choose(width, height)
         classifier_1 = "ca.mcgill.a11y.image.preprocessor.contentCategoriser"
         classifier_2 = "ca.mcgill.a11y.image.preprocessor.graphicTagger"
         if classifier_1 in preprocess_output:
@@ -225,11 +208,9 @@ def run(weights='yolov5x.pt',
                 #     logging.info("Cannot process image")
                 #     return "", 204
                 things = detect_objects(send,
-                                        device,
-                                        weights,
-                                        imgsz,
-                                        half,
-                                        source,
+                                        detector,
+                                        image,
+                                        size,
                                         augment,
                                         width,
                                         height,
@@ -239,20 +220,16 @@ def run(weights='yolov5x.pt',
                                         agnostic_nms,
                                         save_img,
                                         save_crop,
-                                        view_img,
-                                        hide_labels,
-                                        hide_conf)
+                                        view_img)
             else:
                 """We are providing the user the ability to process an image
                 even when the second classifier is absent, however it is
                 recommended to the run objection detection model
                 in conjunction with the second classifier."""
                 things = detect_objects(send,
-                                        device,
-                                        weights,
-                                        imgsz,
-                                        half,
-                                        source,
+                                        detector,
+                                        image,
+                                        size,
                                         augment,
                                         width,
                                         height,
@@ -262,20 +239,16 @@ def run(weights='yolov5x.pt',
                                         agnostic_nms,
                                         save_img,
                                         save_crop,
-                                        view_img,
-                                        hide_labels,
-                                        hide_conf)
+                                        view_img)
         else:
             """We are providing the user the ability to process an image
             even when the first classifier is absent, however it is
             recommended to the run objection detection model
             in conjunction with the first classifier."""
             things = detect_objects(send,
-                                    device,
-                                    weights,
-                                    imgsz,
-                                    half,
-                                    source,
+                                    detector,
+                                    image,
+                                    size,
                                     augment,
                                     width,
                                     height,
@@ -285,9 +258,7 @@ def run(weights='yolov5x.pt',
                                     agnostic_nms,
                                     save_img,
                                     save_crop,
-                                    view_img,
-                                    hide_labels,
-                                    hide_conf)
+                                    view_img)
         try:
             validator = jsonschema.Draft7Validator(data_schema)
             validator.validate(things)
@@ -311,6 +282,16 @@ def run(weights='yolov5x.pt',
         return response
 
 
+@app.route("/health", methods=['GET'])
+def health():
+    """
+    Reports whether the detector has been loaded and warmed up
+    """
+    if model_registry.is_ready():
+        return jsonify("ready"), 200
+    return jsonify("loading"), 503
+
+
 def main():
     run()
 
@@ -0,0 +1,66 @@
+# Copyright (c) 2021 IMAGE Project, Shared Reality Lab, McGill University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# and our Additional Terms along with this program.
+# If not, see
+# <https://github.com/Shared-Reality-Lab/IMAGE-server/blob/main/LICENSE>.
+#
+# On CPU the app (and so the detector) is loaded once in the gunicorn
+# master and the workers are forked from it, sharing the weights' pages
+# copy-on-write instead of each loading its own copy of yolov5x. CUDA
+# cannot be used in a process forked after it was initialised, so with
+# a GPU every worker loads the app itself.
+
+import gc
+import multiprocessing
+import os
+import subprocess
+import sys
+
+bind = '0.0.0.0:5000'
+workers = int(os.environ.get('YOLO_WORKERS', 1))
+threads = int(os.environ.get('YOLO_WORKER_THREADS', 8))
+capture_output = True
+loglevel = 'debug'
+
+
+def uses_cuda():
+    # asked in a separate process so that CUDA is never initialised in
+    # the master; select_device('') picks CUDA whenever it is available
+    try:
+        result = subprocess.run(
+            [sys.executable, '-c',
+             'import torch; print(torch.cuda.is_available())'],
+            capture_output=True, text=True, timeout=120)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return result.stdout.strip() == 'True'
+
+
+preload_app = not uses_cuda()
+
+
+def worker_torch_threads():
+    # split the cores between the workers unless set explicitly
+    threads = int(os.environ.get('YOLO_THREADS', 0))
+    return threads or max(1, multiprocessing.cpu_count() // workers)
+
+
+def when_ready(server):
+    # keep the garbage collector from writing to the objects loaded in
+    # the master, which would copy their pages into every worker
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import model_registry
+    model_registry.after_fork(worker_torch_threads())
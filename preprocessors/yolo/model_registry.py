@@ -0,0 +1,141 @@
+# Copyright (c) 2021 IMAGE Project, Shared Reality Lab, McGill University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# and our Additional Terms along with this program.
+# If not, see
+# <https://github.com/Shared-Reality-Lab/IMAGE-server/blob/main/LICENSE>.
+
+import logging
+import os
+import threading
+import time
+
+import torch
+
+from backends import load_backend
+from utils.general import check_img_size
+from utils.torch_utils import select_device
+
+# Inference backend: eager (default), torchscript or onnx. YOLO_THREADS
+# sets the intra-op thread count and YOLO_INT8 selects the quantized
+# ONNX model
+BACKEND = os.environ.get('YOLO_BACKEND', 'eager')
+THREADS = int(os.environ.get('YOLO_THREADS', 0))
+INT8 = os.environ.get('YOLO_INT8', '0') == '1'
+
+# one detector per set of settings for the whole process
+_detectors = {}
+_lock = threading.Lock()
+
+
+class Detector:
+    """
+    YOLOv5 model that is loaded and warmed up once and then shared
+    by every request handled in this process
+    """
+    def __init__(self, weights, device='', imgsz=640, half=False,
+                 backend=BACKEND, threads=THREADS, int8=INT8):
+        self.weights = weights
+        device = select_device(device)
+        # exported backends are CPU-only and run in full precision
+        self.half = half and device.type != 'cpu' and backend == 'eager'
+        self.backend = load_backend(backend, weights, device, self.half,
+                                    imgsz, threads, int8)
+        self.device = self.backend.device
+        self.stride = self.backend.stride
+        self.names = self.backend.names
+        if not self.backend.dynamic and self.backend.imgsz != imgsz:
+            raise ValueError("{} was exported for {}px, not {}px".format(
+                backend, self.backend.imgsz, imgsz))
+        self.imgsz = check_img_size(imgsz, s=self.stride)
+        # moving average of the per-image latency (ms) for each input size
+        self.latency = {}
+        self.ready = False
+
+    def prepare(self, img):
+        """
+        Converts a letterboxed CHW (or BCHW) uint8 array to the
+        normalised input tensor expected by the model
+        """
+        img = torch.from_numpy(img).to(self.device)
+        img = img.half() if self.half else img.float()
+        img /= 255.0
+        if img.ndimension() == 3:
+            img = img.unsqueeze(0)
+        return img
+
+    def __call__(self, img, augment=False):
+        start = time.time()
+        pred = self.backend(img, augment=augment)
+        self.record(max(img.shape[2:]),
+                    (time.time() - start) * 1000 / img.shape[0])
+        return pred
+
+    def record(self, size, ms):
+        previous = self.latency.get(size)
+        self.latency[size] = ms if previous is None \
+            else 0.8 * previous + 0.2 * ms
+
+    def warmup(self, imgsz=None):
+        """
+        Runs dummy forward passes so the first real request does not
+        pay for lazy initialisation (this is also done on CPU); the
+        second pass gives the latency estimate for this size
+        """
+        imgsz = imgsz or self.imgsz
+        start = time.time()
+        dummy = torch.zeros(1, 3, imgsz, imgsz).to(self.device)
+        dummy = dummy.half() if self.half else dummy
+        self.backend(dummy)
+        self.latency.pop(imgsz, None)
+        self(dummy)
+        logging.info("Warmed up {} ({}) on {} at {}px in {:.2f}s".format(
+            self.weights, type(self.backend).__name__, self.device, imgsz,
+            time.time() - start))
+        self.ready = True
+
+
+def get_detector(weights, device='', imgsz=640, half=False,
+                 backend=BACKEND, threads=THREADS, int8=INT8):
+    """
+    Returns the process-wide detector for the given settings,
+    loading and warming it up on first use
+    """
+    key = (weights, device, imgsz, half, backend, threads, int8)
+    with _lock:
+        if key not in _detectors:
+            logging.info("Loading detector {} ({})".format(weights, backend))
+            detector = Detector(weights, device, imgsz, half,
+                                backend, threads, int8)
+            detector.warmup()
+            _detectors[key] = detector
+    return _detectors[key]
+
+
+def is_ready():
+    """
+    True once every registered detector has been loaded and warmed up
+    """
+    with _lock:
+        return len(_detectors) > 0 and \
+            all(d.ready for d in _detectors.values())
+
+
+def after_fork(threads):
+    """
+    Called in each forked worker: pins its intra-op thread count and
+    reopens backends that cannot be shared across a fork
+    """
+    torch.set_num_threads(threads)
+    with _lock:
+        for detector in _detectors.values():
+            detector.backend.after_fork(threads)
@@ -0,0 +1,92 @@
+# Copyright (c) 2021 IMAGE Project, Shared Reality Lab, McGill University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# and our Additional Terms along with this program.
+# If not, see
+# <https://github.com/Shared-Reality-Lab/IMAGE-server/blob/main/LICENSE>.
+
+import logging
+import os
+import threading
+
+from utils.general import check_img_size
+
+# Candidate inference sizes and the per-image latency budget. Without a
+# budget (0) images are never run above the detector's default size.
+SIZES = [int(s) for s in
+         os.environ.get('YOLO_SIZES', '320,480,640,960').split(',')]
+LATENCY_BUDGET_MS = float(os.environ.get('YOLO_LATENCY_BUDGET_MS', 0))
+
+_policies = {}
+_lock = threading.Lock()
+
+
+class ResolutionPolicy:
+    """
+    Picks the inference size for each image from its dimensions and the
+    latency measured for each size on this machine
+    """
+    def __init__(self, detector, sizes=SIZES, budget_ms=LATENCY_BUDGET_MS):
+        self.detector = detector
+        self.budget_ms = budget_ms
+        if detector.backend.dynamic:
+            self.sizes = sorted({check_img_size(s, s=detector.stride)
+                                 for s in sizes} | {detector.imgsz})
+        else:
+            # a fixed-shape backend can only run its export size
+            self.sizes = [detector.imgsz]
+        # measure every size once so the first estimates are real ones
+        for size in self.sizes:
+            if size not in detector.latency:
+                detector.warmup(size)
+        logging.info("Inference sizes {}, budget {}ms".format(
+            self.sizes, budget_ms or "none"))
+
+    def estimate(self, size):
+        """
+        Expected per-image latency in ms at the given size, scaled by
+        input area from the closest measured size if it was never run
+        """
+        latency = self.detector.latency
+        if size in latency:
+            return latency[size]
+        if not latency:
+            return 0.0
+        known = min(latency, key=lambda s: abs(s - size))
+        return latency[known] * (size / known) ** 2
+
+    def choose(self, width, height):
+        """
+        Smallest size that does not upscale the image, stepped down
+        until it fits the latency budget
+        """
+        longest = max(width, height)
+        fits = [s for s in self.sizes if s >= longest]
+        target = fits[0] if fits else self.sizes[-1]
+        if self.budget_ms <= 0:
+            target = min(target, max(self.detector.imgsz, self.sizes[0]))
+        candidates = [s for s in self.sizes if s <= target]
+        if self.budget_ms > 0:
+            within = [s for s in candidates
+                      if self.estimate(s) <= self.budget_ms]
+            candidates = within or candidates[:1]
+        return candidates[-1]
+
+
+def get_policy(detector):
+    """
+    Returns the resolution policy for the given detector
+    """
+    with _lock:
+        if id(detector) not in _policies:
+            _policies[id(detector)] = ResolutionPolicy(detector)
+    return _policies[id(detector)]
@@ -0,0 +1,103 @@
+# Copyright (c) 2021 IMAGE Project, Shared Reality Lab, McGill University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# You should have received a copy of the GNU Affero General Public License
+# and our Additional Terms along with this program.
+# If not, see
+# <https://github.com/Shared-Reality-Lab/IMAGE-server/blob/main/LICENSE>.
+
+import math
+import os
+
+import torch
+import torchvision
+
+from utils.general import check_img_size
+
+# Graphics whose longest side is at least TILE_MIN_SIDE pixels are split
+# into overlapping TILE_SIZE tiles (0 turns tiling off). If that would
+# give more than MAX_TILES tiles the tiles are made larger instead.
+TILE_MIN_SIDE = int(os.environ.get('YOLO_TILE_MIN_SIDE', 0))
+TILE_SIZE = int(os.environ.get('YOLO_TILE_SIZE', 640))
+TILE_OVERLAP = float(os.environ.get('YOLO_TILE_OVERLAP', 0.2))
+MAX_TILES = int(os.environ.get('YOLO_MAX_TILES', 16))
+
+
+def use_tiling(width, height):
+    return TILE_MIN_SIDE > 0 and max(width, height) >= TILE_MIN_SIDE
+
+
+def tile_imgsz(detector):
+    """
+    Size each tile is run at; fixed-shape backends use their own size
+    """
+    if not detector.backend.dynamic:
+        return detector.imgsz
+    return check_img_size(TILE_SIZE, s=detector.stride)
+
+
+def _origins(length, tile, overlap):
+    # evenly spread tiles so the last one ends on the image edge
+    if length <= tile:
+        return [0]
+    step = max(1, int(tile * (1 - overlap)))
+    n = math.ceil((length - tile) / step) + 1
+    return [round(i * (length - tile) / (n - 1)) for i in range(n)]
+
+
+def make_tiles(width, height, tile=TILE_SIZE, overlap=TILE_OVERLAP,
+               max_tiles=MAX_TILES):
+    """
+    Returns the (x0, y0, x1, y1) pixel regions of the tiles
+    """
+    while True:
+        xs = _origins(width, tile, overlap)
+        ys = _origins(height, tile, overlap)
+        if len(xs) * len(ys) <= max(1, max_tiles):
+            break
+        tile = int(tile * 1.25)
+    tw, th = min(tile, width), min(tile, height)
+    return [(x, y, x + tw, y + th) for y in ys for x in xs]
+
+
+def detect_tiled(scheduler, im0, imgsz, conf_thres=0.25, iou_thres=0.45,
+                 classes=None, agnostic_nms=False, augment=False,
+                 max_det=1000):
+    """
+    Detects objects tile by tile and merges the boxes, in original
+    image coordinates, with a single class-aware NMS
+    """
+    height, width = im0.shape[:2]
+    # the whole image is run alongside the tiles so that objects larger
+    # than a tile are still found
+    regions = [(0, 0, width, height)] + make_tiles(width, height)
+    # the tiles are run as one batch, whatever the batch size limit
+    futures = scheduler.submit_many(
+        [im0[y0:y1, x0:x1] for x0, y0, x1, y1 in regions],
+        imgsz=imgsz, conf_thres=conf_thres, iou_thres=iou_thres,
+        classes=classes, agnostic_nms=agnostic_nms, augment=augment)
+    dets = []
+    for (x0, y0, _, _), future in zip(regions, futures):
+        det = future.result()
+        if len(det):
+            det = det.clone()
+            det[:, [0, 2]] += x0
+            det[:, [1, 3]] += y0
+            dets.append(det)
+    if not dets:
+        return torch.zeros((0, 6))
+    det = torch.cat(dets)
+    boxes, scores = det[:, :4].float(), det[:, 4].float()
+    if agnostic_nms:
+        keep = torchvision.ops.nms(boxes, scores, iou_thres)
+    else:
+        keep = torchvision.ops.batched_nms(boxes, scores, det[:, 5], iou_thres)
+    return det[keep[:max_det]]